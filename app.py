@@ -1,12 +1,20 @@
 # --- START OF FILE app.py ---
 
-from flask import Flask, render_template, request, jsonify, url_for
+from flask import Flask, render_template, request, jsonify, url_for, Response
 import sqlite3
 import os
-from datetime import datetime
+import time
+import json
+import threading
+import multiprocessing
+import uuid
+from datetime import datetime, date, timedelta
 import logging # Para logs
 import pandas as pd # <<--- IMPORT NECESSÁRIO
+import numpy as np
 import traceback # Para debug de erros internos
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as aguardar_futuros, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 # Importar funções do módulo helper
 try:
@@ -26,6 +34,50 @@ app.static_folder = 'static'
 
 DATABASE = 'database.db'
 
+# Previsão em lote: número máximo de itens processados em paralelo.
+# Cada item treina com n_jobs=1, então este é também o limite de núcleos usados.
+MAX_WORKERS_PREVISAO_LOTE = min(4, os.cpu_count() or 1)
+executor_previsao_lote = ThreadPoolExecutor(max_workers=MAX_WORKERS_PREVISAO_LOTE, thread_name_prefix='previsao-lote')
+# Pool de processos para as previsões (treino fora das threads do Flask).
+# A fila é limitada: com todas as vagas ocupadas a API responde "ocupado" (503).
+USAR_POOL_PROCESSOS = True
+MAX_PROCESSOS_PREVISAO = os.cpu_count() or 1
+MAX_FILA_PREVISAO = MAX_PROCESSOS_PREVISAO * 4 # Previsões em execução + aguardando
+# Os núcleos usados pelos treinos de todos os processos do pool são limitados pelo governador de
+# paralelismo do helper_module, compartilhado entre os processos (criado junto com o pool)
+# Processos novos via forkserver (ou spawn): um fork do processo do Flask herdaria as threads e locks
+# dele (executores, agendador) em estado indefinido
+CONTEXTO_PROCESSOS = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+TIMEOUT_PREVISAO = 30 # Segundos que uma requisição espera pelo resultado
+# Previsões pré-calculadas: horizonte (dias) gravado na tabela 'previsao' e intervalo
+# máximo (segundos) entre duas varreduras do agendador em busca de previsões obsoletas
+HORIZONTE_PREVISAO = 7
+INTERVALO_AGENDADOR_PREVISOES = 300
+# Orçamento de latência (segundos) de /api/prever/<id> sem previsão atualizada gravada: se o
+# cálculo não terminar nesse tempo, a resposta traz a última previsão gravada ('obsoleta') ou
+# uma linha de base barata ('provisoria') e o cálculo continua em segundo plano.
+# None = esperar o cálculo (até TIMEOUT_PREVISAO). Pode ser trocado por requisição com ?orcamento=
+ORCAMENTO_LATENCIA_PREVISAO = 2.0
+# Modo padrão da previsão em lote: 'por_item' (um modelo por item) ou 'global' (um modelo
+# treinado com todos os itens). Pode ser escolhido por requisição com ?modo=...
+MODO_PREVISAO_LOTE = 'por_item'
+MODOS_PREVISAO_LOTE = ('por_item', 'global')
+# Jobs de previsão (/api/previsoes/jobs): jobs concluídos ficam em memória por RETENCAO_JOBS_PREVISAO
+# segundos (até MAX_JOBS_PREVISAO), para quem reconectar ao stream receber os resultados já prontos
+MAX_JOBS_PREVISAO = 20
+RETENCAO_JOBS_PREVISAO = 600
+INTERVALO_HEARTBEAT_SSE = 15 # Segundos entre comentários de keep-alive no stream
+# Previsão em lote por NDJSON (/api/prever/lote/ndjson): itens lidos do banco em páginas e no
+# máximo MAX_EM_ANDAMENTO_NDJSON previsões em andamento, então a memória não cresce com o estoque
+TAMANHO_PAGINA_NDJSON = 256
+MAX_EM_ANDAMENTO_NDJSON = MAX_WORKERS_PREVISAO_LOTE * 2
+# Linhas lidas por fetchmany ao montar os arrays NumPy do histórico de um item
+TAMANHO_LOTE_CURSOR = 4096
+# Previsão incremental (opcional): cada consumo atualiza em O(1) o estado da SES do item
+# (tabela 'estado_incremental') e /api/prever só lê esse estado, sem retreinar
+USAR_PREVISAO_INCREMENTAL = False
+
 # Configuração de Logging
 # Adiciona um handler para exibir logs no terminal
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
@@ -45,42 +97,199 @@ def get_db_connection():
         return None
 
 # Função para inicializar o banco de dados
+# (também cria, em bancos já existentes, as tabelas adicionadas depois da versão inicial)
 def init_db():
     if not os.path.exists(DATABASE):
         logging.info(f"Criando banco de dados em {DATABASE}")
-        conn = get_db_connection()
-        if conn:
-            try:
-                with conn:
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS estoque (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            nome TEXT NOT NULL UNIQUE,
-                            quantidade INTEGER NOT NULL CHECK(quantidade >= 0),
-                            data_cadastro TEXT NOT NULL
-                        )
-                    ''')
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS consumo (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            item_id INTEGER NOT NULL,
-                            quantidade INTEGER NOT NULL CHECK(quantidade > 0),
-                            data_consumo TEXT NOT NULL,
-                            FOREIGN KEY (item_id) REFERENCES estoque(id) ON DELETE CASCADE
-                        )
-                    ''')
-                logging.info("Tabelas 'estoque' e 'consumo' criadas ou verificadas.")
-            except sqlite3.Error as e:
-                logging.error(f"Erro ao inicializar tabelas: {e}")
-            finally:
-                conn.close()
-        else:
-             logging.critical("Falha na conexão com DB, não foi possível inicializar tabelas.")
     else:
-        logging.debug(f"Banco de dados {DATABASE} já existe.")
-        # Verificar schema pode ser feito aqui se necessário
-        # Por exemplo, adicionando uma coluna se ela não existir
+        logging.debug(f"Banco de dados {DATABASE} já existe. Verificando schema.")
+    conn = get_db_connection()
+    if conn:
+        try:
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS estoque (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        nome TEXT NOT NULL UNIQUE,
+                        quantidade INTEGER NOT NULL CHECK(quantidade >= 0),
+                        data_cadastro TEXT NOT NULL
+                    )
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS consumo (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        item_id INTEGER NOT NULL,
+                        quantidade INTEGER NOT NULL CHECK(quantidade > 0),
+                        data_consumo TEXT NOT NULL,
+                        data_consumo_epoch INTEGER,
+                        dia_consumo INTEGER,
+                        FOREIGN KEY (item_id) REFERENCES estoque(id) ON DELETE CASCADE
+                    )
+                ''')
+                migrar_colunas_tempo_consumo(conn)
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_consumo_item_dia ON consumo (item_id, dia_consumo)')
+                # Previsões pré-calculadas pelo agendador (uma linha por item e horizonte)
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS previsao (
+                        item_id INTEGER NOT NULL,
+                        horizonte INTEGER NOT NULL,
+                        valor REAL,
+                        metodo TEXT,
+                        mensagem TEXT,
+                        detalhes TEXT,
+                        calculado_em TEXT NOT NULL,
+                        versao_historico TEXT NOT NULL,
+                        obsoleta INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (item_id, horizonte),
+                        FOREIGN KEY (item_id) REFERENCES estoque(id) ON DELETE CASCADE
+                    )
+                ''')
+                # Consumo total por item e dia (número do dia, como 'dia_consumo'), mantido pelos
+                # triggers abaixo: previsões e estatísticas leem esta tabela (uma linha por dia)
+                # em vez de todos os consumos
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS consumo_diario (
+                        item_id INTEGER NOT NULL,
+                        dia INTEGER NOT NULL,
+                        quantidade INTEGER NOT NULL,
+                        PRIMARY KEY (item_id, dia),
+                        FOREIGN KEY (item_id) REFERENCES estoque(id) ON DELETE CASCADE
+                    )
+                ''')
+                criar_triggers_consumo_diario(conn)
+                # Modelo escolhido para cada item pelo job de seleção (backtest)
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS selecao_modelo (
+                        item_id INTEGER PRIMARY KEY,
+                        modelo TEXT NOT NULL,
+                        melhor_modelo TEXT NOT NULL,
+                        erros TEXT NOT NULL,
+                        origens INTEGER NOT NULL,
+                        versao_historico TEXT NOT NULL,
+                        calculado_em TEXT NOT NULL,
+                        FOREIGN KEY (item_id) REFERENCES estoque(id) ON DELETE CASCADE
+                    )
+                ''')
+                # Estado da previsão incremental de cada item (ver USAR_PREVISAO_INCREMENTAL)
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS estado_incremental (
+                        item_id INTEGER PRIMARY KEY,
+                        dia_corrente INTEGER NOT NULL,
+                        acumulado REAL NOT NULL,
+                        nivel REAL,
+                        momento1 REAL,
+                        momento2 REAL,
+                        versao_historico TEXT NOT NULL,
+                        atualizado_em TEXT NOT NULL,
+                        FOREIGN KEY (item_id) REFERENCES estoque(id) ON DELETE CASCADE
+                    )
+                ''')
+            logging.info("Tabelas 'estoque', 'consumo', 'consumo_diario', 'previsao', 'selecao_modelo' e 'estado_incremental' criadas ou verificadas.")
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao inicializar tabelas: {e}")
+        finally:
+            conn.close()
+    else:
+         logging.critical("Falha na conexão com DB, não foi possível inicializar tabelas.")
+
+
+# Colunas inteiras de data em 'consumo' ('data_consumo' continua sendo gravada, por
+# compatibilidade): data_consumo_epoch = segundos desde 1970-01-01 UTC (o instante real) e
+# dia_consumo = dias desde 1970-01-01 da data do calendário local (o mesmo de date(data_consumo)).
+# 'data_consumo' é a hora local sem fuso: o epoch a converte do fuso local ('utc' no SQLite),
+# o dia é calculado sobre a própria hora local.
+def sql_epoch_consumo(expressao):
+    return f"CAST(strftime('%s', {expressao}, 'utc') AS INTEGER)"
+
+def sql_dia_consumo(expressao):
+    return f"CAST(strftime('%s', {expressao}) AS INTEGER) / 86400"
+
+def tempo_consumo(data_hora):
+    """(data_consumo_epoch, dia_consumo) de um datetime sem fuso, em hora local (mesma conversão do SQLite)."""
+    return int(data_hora.timestamp()), data_hora.date().toordinal() - date(1970, 1, 1).toordinal()
+
+# Mantêm as colunas inteiras para quem grava ou altera só 'data_consumo' (consumir_item já
+# as informa no INSERT). Não disparam os triggers de 'consumo_diario', que não olham essas colunas.
+SQL_PREENCHER_COLUNAS_TEMPO = f"""
+    UPDATE consumo SET data_consumo_epoch = {sql_epoch_consumo('data_consumo')},
+                       dia_consumo = {sql_dia_consumo('data_consumo')}
+"""
+TRIGGERS_COLUNAS_TEMPO_CONSUMO = {
+    'consumo_tempo_apos_inserir': f'''
+        CREATE TRIGGER IF NOT EXISTS consumo_tempo_apos_inserir AFTER INSERT ON consumo
+        WHEN NEW.data_consumo_epoch IS NULL
+        BEGIN {SQL_PREENCHER_COLUNAS_TEMPO} WHERE id = NEW.id; END
+    ''',
+    'consumo_tempo_apos_alterar': f'''
+        CREATE TRIGGER IF NOT EXISTS consumo_tempo_apos_alterar AFTER UPDATE OF data_consumo ON consumo
+        BEGIN {SQL_PREENCHER_COLUNAS_TEMPO} WHERE id = NEW.id; END
+    ''',
+}
 
+# Cria as colunas inteiras em bancos antigos, preenche as linhas que ainda não as têm e
+# cria os triggers que as mantêm
+def migrar_colunas_tempo_consumo(conn):
+    colunas = {row['name'] for row in conn.execute('PRAGMA table_info(consumo)')}
+    for coluna in ('data_consumo_epoch', 'dia_consumo'):
+        if coluna not in colunas:
+            conn.execute(f'ALTER TABLE consumo ADD COLUMN {coluna} INTEGER')
+    res = conn.execute(SQL_PREENCHER_COLUNAS_TEMPO + " WHERE data_consumo_epoch IS NULL AND strftime('%s', data_consumo) IS NOT NULL")
+    if res.rowcount > 0:
+        logging.info(f"Colunas de data inteiras preenchidas em {res.rowcount} consumos.")
+    for sql in TRIGGERS_COLUNAS_TEMPO_CONSUMO.values():
+        conn.execute(sql)
+
+# Triggers que mantêm 'consumo_diario' em dia com 'consumo' (inserção, alteração e exclusão,
+# inclusive a exclusão em cascata do item). O dia vem de 'data_consumo', então vale também
+# para quem grava só o texto. Consumos com data inválida não entram no total.
+TRIGGERS_CONSUMO_DIARIO = {
+    'consumo_diario_apos_inserir': f'''
+        CREATE TRIGGER consumo_diario_apos_inserir AFTER INSERT ON consumo
+        WHEN {sql_dia_consumo('NEW.data_consumo')} IS NOT NULL
+        BEGIN
+            INSERT INTO consumo_diario (item_id, dia, quantidade) VALUES (NEW.item_id, {sql_dia_consumo('NEW.data_consumo')}, NEW.quantidade)
+            ON CONFLICT (item_id, dia) DO UPDATE SET quantidade = quantidade + excluded.quantidade;
+        END
+    ''',
+    'consumo_diario_apos_excluir': f'''
+        CREATE TRIGGER consumo_diario_apos_excluir AFTER DELETE ON consumo
+        WHEN {sql_dia_consumo('OLD.data_consumo')} IS NOT NULL
+        BEGIN
+            UPDATE consumo_diario SET quantidade = quantidade - OLD.quantidade
+            WHERE item_id = OLD.item_id AND dia = {sql_dia_consumo('OLD.data_consumo')};
+            DELETE FROM consumo_diario WHERE item_id = OLD.item_id AND dia = {sql_dia_consumo('OLD.data_consumo')} AND quantidade <= 0;
+        END
+    ''',
+    'consumo_diario_apos_alterar': f'''
+        CREATE TRIGGER consumo_diario_apos_alterar AFTER UPDATE OF item_id, quantidade, data_consumo ON consumo
+        BEGIN
+            UPDATE consumo_diario SET quantidade = quantidade - OLD.quantidade
+            WHERE item_id = OLD.item_id AND dia = {sql_dia_consumo('OLD.data_consumo')};
+            DELETE FROM consumo_diario WHERE item_id = OLD.item_id AND dia = {sql_dia_consumo('OLD.data_consumo')} AND quantidade <= 0;
+            INSERT INTO consumo_diario (item_id, dia, quantidade)
+            SELECT NEW.item_id, {sql_dia_consumo('NEW.data_consumo')}, NEW.quantidade WHERE {sql_dia_consumo('NEW.data_consumo')} IS NOT NULL
+            ON CONFLICT (item_id, dia) DO UPDATE SET quantidade = quantidade + excluded.quantidade;
+        END
+    ''',
+}
+
+# Cria os triggers que faltam. Se algum faltava (banco anterior à tabela 'consumo_diario' ou
+# triggers removidos), a tabela é recalculada a partir de 'consumo' na mesma transação.
+def criar_triggers_consumo_diario(conn):
+    existentes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    faltando = [nome for nome in TRIGGERS_CONSUMO_DIARIO if nome not in existentes]
+    if not faltando:
+        return
+    conn.execute('DELETE FROM consumo_diario')
+    conn.execute('''
+        INSERT INTO consumo_diario (item_id, dia, quantidade)
+        SELECT item_id, dia_consumo, SUM(quantidade) FROM consumo
+        WHERE dia_consumo IS NOT NULL
+        GROUP BY item_id, dia_consumo
+    ''')
+    for nome in faltando:
+        conn.execute(TRIGGERS_CONSUMO_DIARIO[nome])
+    logging.info(f"Tabela 'consumo_diario' recalculada a partir de 'consumo' (triggers criados: {', '.join(faltando)}).")
 
 # Filtro Jinja para formatar data/hora
 def format_datetime_filter(value):
@@ -102,6 +311,174 @@ def format_datetime_filter(value):
 
 app.jinja_env.filters['strftime'] = format_datetime_filter
 
+# Filtro Jinja para formatar um número de dia (dias desde 1970-01-01) sem converter texto
+def format_dia_filter(value):
+    if not isinstance(value, int):
+        return ""
+    return (date(1970, 1, 1) + timedelta(days=value)).strftime("%d/%m/%Y")
+
+app.jinja_env.filters['data_dia'] = format_dia_filter
+
+# --- POOL DE PROCESSOS DE PREVISÃO ---
+
+class ServidorOcupado(Exception):
+    """A fila do pool de previsões está cheia."""
+
+_pool_previsoes = None
+_lock_pool_previsoes = threading.Lock()
+_vagas_fila_previsao = threading.BoundedSemaphore(MAX_FILA_PREVISAO)
+metricas_pool_previsoes = {'enviadas': 0, 'concluidas': 0, 'rejeitadas': 0, 'timeouts': 0}
+# Contadores do cache e do repositório de modelos dos processos do pool, somados a cada resultado
+# (ver helper_module.executar_com_metricas), e o tamanho mais recente do cache de cada processo
+metricas_processos_previsao = {'cache_modelos': {'acertos': 0, 'falhas': 0, 'remocoes': 0},
+                               'repositorio_modelos': {'carregados': 0, 'salvos': 0, 'descartados': 0}}
+_tamanho_cache_processos = {}
+_lock_metricas_pool = threading.Lock()
+
+def _contar_metrica_pool(nome):
+    with _lock_metricas_pool:
+        metricas_pool_previsoes[nome] += 1
+
+def _acumular_metricas_processo(metricas):
+    with _lock_metricas_pool:
+        for grupo in ('cache_modelos', 'repositorio_modelos'):
+            for nome, valor in metricas[grupo].items():
+                metricas_processos_previsao[grupo][nome] += valor
+        _tamanho_cache_processos[metricas['pid']] = metricas['tamanho_cache']
+
+def _somar_metricas_processos(estatisticas, grupo):
+    """Soma às estatísticas deste processo os contadores acumulados dos processos do pool."""
+    with _lock_metricas_pool:
+        for nome, valor in metricas_processos_previsao[grupo].items():
+            estatisticas[nome] += valor
+        if grupo == 'cache_modelos':
+            estatisticas['tamanho'] += sum(_tamanho_cache_processos.values())
+    if grupo == 'cache_modelos':
+        total = estatisticas['acertos'] + estatisticas['falhas']
+        estatisticas['taxa_acerto'] = round(estatisticas['acertos'] / total, 4) if total else None
+    return estatisticas
+
+def _liberar_vaga_previsao(_futuro=None):
+    _vagas_fila_previsao.release()
+    _contar_metrica_pool('concluidas')
+
+def obter_pool_previsoes():
+    global _pool_previsoes
+    with _lock_pool_previsoes:
+        if _pool_previsoes is None:
+            logging.info(f"Iniciando pool de previsões com {MAX_PROCESSOS_PREVISAO} processos.")
+            # Governador novo a cada pool: núcleos presos por um processo que morreu não voltariam
+            governador = helper_module.criar_governador_compartilhado(CONTEXTO_PROCESSOS, treinos_esperados=MAX_PROCESSOS_PREVISAO)
+            _pool_previsoes = ProcessPoolExecutor(max_workers=MAX_PROCESSOS_PREVISAO, mp_context=CONTEXTO_PROCESSOS,
+                                                  initializer=helper_module.inicializar_processo_previsao,
+                                                  initargs=(governador,))
+        return _pool_previsoes
+
+def _descartar_pool_previsoes(pool):
+    global _pool_previsoes
+    with _lock_pool_previsoes:
+        if _pool_previsoes is pool:
+            _pool_previsoes = None
+            with _lock_metricas_pool:
+                _tamanho_cache_processos.clear() # Os caches dos processos antigos se perdem com eles
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# Executa uma função de previsão do helper_module no pool de processos e espera o resultado.
+# Levanta ServidorOcupado se não houver vaga na fila em `espera_vaga` segundos e
+# FuturesTimeoutError se o resultado não ficar pronto em TIMEOUT_PREVISAO segundos.
+def executar_previsao(funcao, *args, espera_vaga=0, **kwargs):
+    if not USAR_POOL_PROCESSOS:
+        return funcao(*args, **kwargs)
+
+    if not _vagas_fila_previsao.acquire(timeout=espera_vaga):
+        _contar_metrica_pool('rejeitadas')
+        raise ServidorOcupado()
+    pool = obter_pool_previsoes()
+    try:
+        futuro = pool.submit(helper_module.executar_com_metricas, funcao, *args, **kwargs)
+    except (BrokenProcessPool, RuntimeError):
+        _vagas_fila_previsao.release()
+        _descartar_pool_previsoes(pool)
+        raise
+    _contar_metrica_pool('enviadas')
+    futuro.add_done_callback(_liberar_vaga_previsao)
+
+    try:
+        resultado, metricas = futuro.result(timeout=TIMEOUT_PREVISAO)
+    except FuturesTimeoutError:
+        _contar_metrica_pool('timeouts')
+        raise
+    except BrokenProcessPool:
+        logging.error("Pool de previsões quebrado (processo encerrado inesperadamente). Será recriado.")
+        _descartar_pool_previsoes(pool)
+        raise
+    _acumular_metricas_processo(metricas)
+    return resultado
+
+def resposta_servidor_ocupado():
+    resposta = jsonify(message='Servidor ocupado calculando outras previsões. Tente novamente em instantes.', ocupado=True)
+    resposta.headers['Retry-After'] = '5'
+    return resposta, 503
+
+# --- EXECUÇÃO ÚNICA (SINGLE-FLIGHT) ---
+
+class ExecucaoUnica:
+    """
+    Agrupa cálculos idênticos simultâneos: enquanto houver um cálculo em andamento para uma
+    chave (e.g., item e versão do histórico), quem pedir a mesma chave espera por ele e recebe
+    o mesmo resultado (ou a mesma exceção) em vez de repetir a busca e o treino.
+    O resultado é compartilhado: quem for alterá-lo deve alterar uma cópia.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_andamento = {}
+        self.execucoes = 0
+        self.agrupadas = 0
+
+    def _registrar(self, chave):
+        """Retorna (futuro, True se quem chamou deve calcular)."""
+        with self._lock:
+            futuro = self._em_andamento.get(chave)
+            if futuro is not None:
+                self.agrupadas += 1
+                return futuro, False
+            futuro = Future()
+            self._em_andamento[chave] = futuro
+            self.execucoes += 1
+            return futuro, True
+
+    def _calcular(self, chave, futuro, funcao, args, kwargs):
+        try:
+            resultado = funcao(*args, **kwargs)
+        except BaseException as e:
+            futuro.set_exception(e)
+        else:
+            futuro.set_result(resultado)
+        finally:
+            with self._lock:
+                del self._em_andamento[chave]
+
+    def executar(self, chave, funcao, *args, **kwargs):
+        """Calcula na thread atual (ou espera o cálculo em andamento) e retorna o resultado."""
+        futuro, calcular = self._registrar(chave)
+        if calcular:
+            self._calcular(chave, futuro, funcao, args, kwargs)
+        return futuro.result()
+
+    def submeter(self, chave, executor, funcao, *args, **kwargs):
+        """Calcula em `executor` (ou reaproveita o cálculo em andamento); retorna o futuro."""
+        futuro, calcular = self._registrar(chave)
+        if calcular:
+            executor.submit(self._calcular, chave, futuro, funcao, args, kwargs)
+        return futuro
+
+    def estatisticas(self):
+        with self._lock:
+            return {'execucoes': self.execucoes, 'agrupadas': self.agrupadas, 'em_andamento': len(self._em_andamento)}
+
+# Previsões por item ('previsao', item_id, versão) e por item no lote ('lote', item_id, versão, modelo)
+execucao_unica_previsoes = ExecucaoUnica()
+
 # --- ROTAS PRINCIPAIS (HTML) ---
 
 @app.route('/')
@@ -132,11 +509,11 @@ def estatisticas_page():
     dados_template = {}
     try:
         itens_consumo_raw = conn.execute('''
-            SELECT e.nome, c.data_consumo, c.quantidade
-            FROM consumo c JOIN estoque e ON c.item_id = e.id
-            ORDER BY e.nome COLLATE NOCASE, c.data_consumo DESC
+            SELECT e.nome, c.dia, c.quantidade
+            FROM consumo_diario c JOIN estoque e ON c.item_id = e.id
+            ORDER BY e.nome COLLATE NOCASE, c.dia DESC
         ''').fetchall()
-        logging.debug(f"Encontrados {len(itens_consumo_raw)} registros de consumo para estatísticas.")
+        logging.debug(f"Encontrados {len(itens_consumo_raw)} dias com consumo para estatísticas.")
 
         for item in itens_consumo_raw:
             nome = item['nome']
@@ -167,32 +544,405 @@ def api_get_estoque():
     finally:
         if conn: conn.close()
 
-# Função auxiliar para buscar dados de consumo para previsão
+# Função auxiliar para buscar dados de consumo para previsão, já agregados por dia (tabela
+# 'consumo_diario'). As linhas vão do cursor direto para arrays NumPy, sem DataFrame.
+# Retorna (números de dia int64 (dias desde 1970-01-01), quantidades float64) ou None em caso de erro.
+DTYPE_CONSUMO_DIARIO = np.dtype([('dia', np.int64), ('quantidade', np.float64)])
+
 def fetch_consumo_data_for_prediction(item_id, conn):
      try:
-        df = pd.read_sql_query(
-            "SELECT data_consumo, quantidade FROM consumo WHERE item_id = ? ORDER BY data_consumo ASC",
-            conn,
-            params=(item_id,)
+        cursor = conn.cursor()
+        cursor.row_factory = None # Tuplas simples, que o np.fromiter converte direto
+        cursor.execute(
+            "SELECT dia, quantidade FROM consumo_diario WHERE item_id = ? ORDER BY dia ASC",
+            (item_id,)
         )
-        logging.debug(f"Buscados {len(df)} registros de consumo para item {item_id} para previsão.")
-        return df
+        blocos = []
+        while True:
+            linhas = cursor.fetchmany(TAMANHO_LOTE_CURSOR)
+            if not linhas:
+                break
+            blocos.append(np.fromiter(linhas, dtype=DTYPE_CONSUMO_DIARIO, count=len(linhas)))
+        dados = np.concatenate(blocos) if blocos else np.empty(0, dtype=DTYPE_CONSUMO_DIARIO)
+        logging.debug(f"Buscados {len(dados)} dias com consumo para item {item_id} para previsão.")
+        return np.ascontiguousarray(dados['dia']), np.ascontiguousarray(dados['quantidade'])
      except sqlite3.Error as e:
         logging.error(f"Erro DB ao buscar consumo para item {item_id}: {e}")
         return None
-     except Exception as pd_err:
-        logging.error(f"Erro Pandas ao buscar consumo para item {item_id}: {pd_err}")
+
+# Função auxiliar para identificar a versão do histórico de consumo de um item
+# (muda sempre que um consumo é registrado; usada como chave do cache de modelos)
+def formatar_versao_historico(total, ultimo_id):
+    return f"{total}-{ultimo_id or 0}"
+
+def obter_versao_historico(item_id, conn):
+    try:
+        row = conn.execute('SELECT COUNT(*) AS total, MAX(id) AS ultimo_id FROM consumo WHERE item_id = ?', (item_id,)).fetchone()
+        return formatar_versao_historico(row['total'], row['ultimo_id'])
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB ao buscar versão do histórico do item {item_id}: {e}")
+        return None
+
+# Versão do histórico de todos os itens do estoque (item_id -> versão)
+def obter_versoes_historico_todos(conn):
+    rows = conn.execute('''
+        SELECT e.id AS item_id, COUNT(c.id) AS total, MAX(c.id) AS ultimo_id
+        FROM estoque e LEFT JOIN consumo c ON c.item_id = e.id
+        GROUP BY e.id
+    ''').fetchall()
+    return {row['item_id']: formatar_versao_historico(row['total'], row['ultimo_id']) for row in rows}
+
+# Função auxiliar para buscar, em uma única consulta, o histórico de consumo de todos os itens,
+# agregado por item e dia (tabela 'consumo_diario'; colunas 'item_id', 'dia' e 'quantidade')
+def fetch_consumo_data_lote(conn):
+    try:
+        df = pd.read_sql_query(
+            "SELECT item_id, dia, quantidade FROM consumo_diario ORDER BY item_id, dia ASC",
+            conn
+        )
+        logging.debug(f"Buscados {len(df)} dias com consumo (todos os itens) para previsão em lote.")
+        return df
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB ao buscar consumo para previsão em lote: {e}")
+        return None
+    except Exception as pd_err:
+        logging.error(f"Erro Pandas ao buscar consumo para previsão em lote: {pd_err}")
+        return None
+
+# Modelos escolhidos pela seleção por backtest (item_id -> modelo); todos ou só de um item
+def obter_modelos_selecionados(conn, item_id=None):
+    if item_id is None:
+        rows = conn.execute('SELECT item_id, modelo FROM selecao_modelo').fetchall()
+    else:
+        rows = conn.execute('SELECT item_id, modelo FROM selecao_modelo WHERE item_id = ?', (item_id,)).fetchall()
+    return {row['item_id']: row['modelo'] for row in rows}
+
+# Job de seleção de modelos: backtest de todos os itens (em paralelo) e gravação do vencedor
+# de cada um em 'selecao_modelo'. As previsões dos itens avaliados ficam obsoletas.
+def executar_job_selecao_modelos():
+    conn = get_db_connection()
+    if not conn:
+        logging.error("Seleção de modelos: falha ao conectar ao banco de dados.")
+        return None
+    try:
+        versoes = obter_versoes_historico_todos(conn)
+        df_todos = fetch_consumo_data_lote(conn)
+        if df_todos is None:
+            return None
+        series = {}
+        for item_id, df_item in df_todos.groupby('item_id', sort=False):
+            serie = helper_module.serie_consumo_diario(df_item)
+            if not serie.empty and item_id in versoes:
+                series[item_id] = (serie.to_numpy(dtype=float), helper_module.numero_dia(serie.index[0]))
+
+        inicio = time.perf_counter()
+        resultados = helper_module.executar_selecao_modelos(series, dias_para_prever=HORIZONTE_PREVISAO,
+                                                            max_workers=MAX_PROCESSOS_PREVISAO)
+        calculado_em = datetime.now().isoformat(timespec='seconds')
+        selecionados = {item_id: r for item_id, r in resultados.items() if r['modelo'] is not None}
+        with conn:
+            for item_id, resultado in selecionados.items():
+                conn.execute('''
+                    INSERT INTO selecao_modelo (item_id, modelo, melhor_modelo, erros, origens, versao_historico, calculado_em)
+                    SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM estoque WHERE id = ?)
+                    ON CONFLICT (item_id) DO UPDATE SET
+                        modelo = excluded.modelo, melhor_modelo = excluded.melhor_modelo, erros = excluded.erros,
+                        origens = excluded.origens, versao_historico = excluded.versao_historico, calculado_em = excluded.calculado_em
+                ''', (item_id, resultado['modelo'], resultado['melhor_modelo'], json.dumps(resultado['erros']),
+                      resultado['origens'], versoes[item_id], calculado_em, item_id))
+                marcar_previsao_obsoleta(item_id, conn)
+        evento_recalcular_previsoes.set()
+        logging.info(f"Seleção de modelos concluída em {time.perf_counter() - inicio:.1f}s: "
+                     f"{len(selecionados)} de {len(series)} itens com modelo selecionado.")
+        return selecionados
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB na seleção de modelos: {e}")
+        return None
+    finally:
+        conn.close()
+
+@app.cli.command('selecionar-modelos')
+def comando_selecionar_modelos():
+    """Executa o backtest de todos os itens e grava o modelo escolhido para cada um."""
+    init_db()
+    selecionados = executar_job_selecao_modelos()
+    if selecionados is None:
+        print("Falha na seleção de modelos. Verifique os logs.")
+        return
+    for item_id, resultado in sorted(selecionados.items()):
+        erros = ', '.join(f"{modelo}={erro:.2f}" for modelo, erro in resultado['erros'].items())
+        print(f"Item {item_id}: {resultado['modelo']} (melhor: {resultado['melhor_modelo']}; MAE {erros})")
+
+# Executa a previsão de um item do lote (roda em uma thread do executor_previsao_lote)
+def _prever_item_lote(item, df_consumo, versao_historico, modelo_preferido=None):
+    try:
+        # Lotes simultâneos (várias abas, clique duplo) calculam cada item uma única vez
+        resultado = dict(execucao_unica_previsoes.executar(
+            ('lote', item['id'], versao_historico, modelo_preferido), executar_previsao,
+            helper_module.obter_previsao_sklearn, df_consumo, item_id=item['id'], versao_historico=versao_historico,
+            n_jobs=1, modelo_preferido=modelo_preferido, espera_vaga=TIMEOUT_PREVISAO))
+    except ServidorOcupado:
+        resultado = {'previsao': None, 'erro': 'Servidor ocupado. Tente novamente em instantes.'}
+    except FuturesTimeoutError:
+        resultado = {'previsao': None, 'erro': f'Tempo limite ({TIMEOUT_PREVISAO}s) excedido ao prever o item.'}
+    except Exception as e:
+        logging.error(f"Erro inesperado na previsão em lote do item {item['id']}: {e}\n{traceback.format_exc()}")
+        resultado = {'previsao': None, 'erro': f'Erro inesperado no servidor ao prever item {item["id"]}.'}
+    resultado['item_id'] = item['id']
+    resultado['nome_item'] = item['nome']
+    resultado['estoque_atual'] = item['quantidade']
+    return resultado
+
+# --- PREVISÕES PRÉ-CALCULADAS (TABELA 'previsao') ---
+
+# Acordado sempre que uma previsão fica obsoleta, para o agendador não esperar o intervalo
+evento_recalcular_previsoes = threading.Event()
+
+# Marca a previsão do item como obsoleta (chamar dentro da transação que altera o item/consumo)
+def marcar_previsao_obsoleta(item_id, conn):
+    conn.execute('UPDATE previsao SET obsoleta = 1 WHERE item_id = ?', (item_id,))
+
+# Busca a previsão gravada do item, se ainda corresponder à versão atual do histórico
+def buscar_previsao_armazenada(item_id, versao_historico, conn):
+    row = conn.execute(
+        'SELECT detalhes, calculado_em FROM previsao WHERE item_id = ? AND horizonte = ? AND obsoleta = 0 AND versao_historico = ?',
+        (item_id, HORIZONTE_PREVISAO, versao_historico)
+    ).fetchone()
+    if row is None:
+        return None
+    resultado = json.loads(row['detalhes'])
+    resultado['calculado_em'] = row['calculado_em']
+    return resultado
+
+# Calcula a previsão do item (no pool de previsões) e grava na tabela 'previsao'.
+# Retorna o resultado ou None (erro de DB); propaga ServidorOcupado e FuturesTimeoutError.
+# `espera_vaga`: segundos que o cálculo espera por uma vaga no pool (ver executar_previsao)
+def calcular_e_salvar_previsao(item_id, conn, n_jobs=-1, espera_vaga=0):
+    versao_historico = obter_versao_historico(item_id, conn)
+    historico = fetch_consumo_data_for_prediction(item_id, conn)
+    if versao_historico is None or historico is None: # Erro já logado nas funções auxiliares
         return None
+    dias, quantidades = historico
+
+    modelo_preferido = obter_modelos_selecionados(conn, item_id).get(item_id)
+    logging.debug(f"Chamando helper_module.obter_previsao_arrays para item {item_id} com {len(dias)} dias com consumo (versão {versao_historico}, modelo {modelo_preferido or 'automático'}).")
+    resultado = executar_previsao(helper_module.obter_previsao_arrays, dias, quantidades, dias_para_prever=HORIZONTE_PREVISAO,
+                                  item_id=item_id, versao_historico=versao_historico, n_jobs=n_jobs,
+                                  modelo_preferido=modelo_preferido, espera_vaga=espera_vaga)
+    calculado_em = datetime.now().isoformat(timespec='seconds')
+
+    try:
+        with conn:
+            # Se chegou consumo novo durante o cálculo, a previsão já nasce obsoleta
+            obsoleta = int(obter_versao_historico(item_id, conn) != versao_historico)
+            conn.execute('''
+                INSERT INTO previsao (item_id, horizonte, valor, metodo, mensagem, detalhes, calculado_em, versao_historico, obsoleta)
+                SELECT ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM estoque WHERE id = ?)
+                ON CONFLICT (item_id, horizonte) DO UPDATE SET
+                    valor = excluded.valor, metodo = excluded.metodo, mensagem = excluded.mensagem,
+                    detalhes = excluded.detalhes, calculado_em = excluded.calculado_em,
+                    versao_historico = excluded.versao_historico, obsoleta = excluded.obsoleta
+            ''', (item_id, HORIZONTE_PREVISAO, resultado.get('previsao'), resultado.get('metodo'), resultado.get('message'),
+                  json.dumps(resultado), calculado_em, versao_historico, obsoleta, item_id))
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB ao gravar previsão do item {item_id}: {e}")
+
+    resultado['calculado_em'] = calculado_em
+    return resultado
+
+# --- Previsão incremental ---
+CAMPOS_ESTADO_INCREMENTAL = ('dia_corrente', 'acumulado', 'nivel', 'momento1', 'momento2')
+
+def gravar_estado_incremental(item_id, estado, versao_historico, conn):
+    conn.execute('''
+        INSERT INTO estado_incremental (item_id, dia_corrente, acumulado, nivel, momento1, momento2, versao_historico, atualizado_em)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (item_id) DO UPDATE SET
+            dia_corrente = excluded.dia_corrente, acumulado = excluded.acumulado, nivel = excluded.nivel,
+            momento1 = excluded.momento1, momento2 = excluded.momento2,
+            versao_historico = excluded.versao_historico, atualizado_em = excluded.atualizado_em
+    ''', (item_id, *(estado[campo] for campo in CAMPOS_ESTADO_INCREMENTAL), versao_historico,
+          datetime.now().isoformat(timespec='seconds')))
+
+# Remonta o estado incremental a partir de 'consumo_diario' (O(dias)) e grava.
+# Retorna (estado, versão) ou (None, None) se o item não tem consumo ou houve erro de DB.
+def montar_estado_incremental(item_id, conn):
+    versao_historico = obter_versao_historico(item_id, conn)
+    historico = fetch_consumo_data_for_prediction(item_id, conn)
+    if versao_historico is None or historico is None or len(historico[0]) == 0:
+        return None, None
+    valores, dia_inicial = helper_module.valores_diarios_de_arrays(*historico)
+    estado = helper_module.estado_incremental_de_valores(valores, dia_inicial)
+    gravar_estado_incremental(item_id, estado, versao_historico, conn)
+    logging.debug(f"Estado incremental do item {item_id} remontado a partir de {len(valores)} dias (versão {versao_historico}).")
+    return estado, versao_historico
+
+# Aplica um consumo recém-inserido ao estado do item (chamar dentro da transação do INSERT).
+# Em O(1): a versão do histórico também é avançada sem consulta (uma linha a mais, novo MAX(id));
+# se o estado gravado já estava defasado, a versão não bate e a leitura remonta o estado.
+def registrar_consumo_incremental(item_id, consumo_id, dia, quantidade, conn):
+    row = conn.execute('SELECT * FROM estado_incremental WHERE item_id = ?', (item_id,)).fetchone()
+    estado = None
+    if row is not None:
+        estado = helper_module.atualizar_estado_incremental({campo: row[campo] for campo in CAMPOS_ESTADO_INCREMENTAL}, dia, quantidade)
+    if estado is None: # Sem estado ou consumo fora de ordem
+        montar_estado_incremental(item_id, conn)
+        return
+    total = int(row['versao_historico'].split('-')[0])
+    gravar_estado_incremental(item_id, estado, formatar_versao_historico(total + 1, consumo_id), conn)
+
+# Previsão lida do estado incremental (remontado se ausente ou de outra versão do histórico).
+# Retorna None se o item não tem consumo, para o chamador seguir o caminho normal.
+def obter_previsao_incremental(item_id, versao_historico, conn):
+    row = conn.execute('SELECT * FROM estado_incremental WHERE item_id = ?', (item_id,)).fetchone()
+    if row is not None and row['versao_historico'] == versao_historico:
+        estado, atualizado_em = {campo: row[campo] for campo in CAMPOS_ESTADO_INCREMENTAL}, row['atualizado_em']
+    else:
+        with conn:
+            estado, _ = montar_estado_incremental(item_id, conn)
+        if estado is None:
+            return None
+        atualizado_em = datetime.now().isoformat(timespec='seconds')
+    resultado = helper_module.prever_estado_incremental(estado, HORIZONTE_PREVISAO)
+    resultado['calculado_em'] = atualizado_em
+    return resultado
+
+# --- Atualização de previsões em segundo plano (orçamento de latência) ---
+# Uma atualização por item e versão do histórico (execucao_unica_previsoes): requisições
+# repetidas, e cálculos síncronos da mesma previsão, reaproveitam a que já está em andamento
+executor_atualizacao_previsoes = ThreadPoolExecutor(max_workers=MAX_FILA_PREVISAO, thread_name_prefix='atualizacao-previsao')
+
+def _atualizar_previsao(item_id):
+    conn = get_db_connection()
+    if not conn:
+        raise sqlite3.OperationalError('Falha ao conectar ao banco de dados.')
+    try:
+        return calcular_e_salvar_previsao(item_id, conn)
+    finally:
+        conn.close()
+
+def _logar_erro_atualizacao(item_id, futuro):
+    erro = futuro.exception()
+    if isinstance(erro, ServidorOcupado):
+        logging.info(f"Atualização da previsão do item {item_id}: pool ocupado, fica para o agendador.")
+        evento_recalcular_previsoes.set()
+    elif isinstance(erro, FuturesTimeoutError):
+        logging.warning(f"Atualização da previsão do item {item_id}: tempo limite de {TIMEOUT_PREVISAO}s excedido.")
+    elif erro is not None:
+        logging.error(f"Erro na atualização da previsão do item {item_id}: {erro}")
+
+# Agenda (ou reaproveita) o cálculo completo da previsão do item em segundo plano
+def agendar_atualizacao_previsao(item_id, versao_historico):
+    futuro = execucao_unica_previsoes.submeter(('previsao', item_id, versao_historico), executor_atualizacao_previsoes,
+                                               _atualizar_previsao, item_id)
+    futuro.add_done_callback(lambda f: _logar_erro_atualizacao(item_id, f))
+    return futuro
+
+# Resposta enquanto a previsão completa não fica pronta: a última gravada (de um histórico
+# anterior) ou, se o item nunca teve previsão, a linha de base barata do helper_module
+def buscar_previsao_substituta(item_id, conn):
+    row = conn.execute('SELECT detalhes, calculado_em FROM previsao WHERE item_id = ? AND horizonte = ?',
+                       (item_id, HORIZONTE_PREVISAO)).fetchone()
+    if row is not None:
+        resultado = json.loads(row['detalhes'])
+        resultado['calculado_em'] = row['calculado_em']
+        return resultado, 'obsoleta'
+    historico = fetch_consumo_data_for_prediction(item_id, conn)
+    if historico is None: # Erro já logado
+        return None, None
+    resultado = helper_module.prever_linha_de_base(*historico, dias_para_prever=HORIZONTE_PREVISAO)
+    resultado['calculado_em'] = datetime.now().isoformat(timespec='seconds')
+    return resultado, 'provisoria'
+
+# Estado da previsão ('fresca', 'obsoleta' ou 'provisoria') e idade (segundos desde o cálculo)
+def marcar_estado_previsao(resultado, estado):
+    resultado['estado'] = estado
+    calculado_em = resultado.get('calculado_em')
+    idade = (datetime.now() - datetime.fromisoformat(calculado_em)).total_seconds() if calculado_em else 0
+    resultado['idade_segundos'] = max(0, int(idade))
+    return resultado
+
+# Recalcula as previsões ausentes ou obsoletas. Retorna o número de itens recalculados.
+def recalcular_previsoes_obsoletas():
+    conn = get_db_connection()
+    if not conn:
+        logging.error("Agendador de previsões: falha ao conectar ao banco de dados.")
+        return 0
+    try:
+        itens = conn.execute('''
+            SELECT e.id FROM estoque e
+            LEFT JOIN previsao p ON p.item_id = e.id AND p.horizonte = ?
+            WHERE p.item_id IS NULL OR p.obsoleta = 1
+        ''', (HORIZONTE_PREVISAO,)).fetchall()
+        recalculadas = 0
+        for item in itens:
+            # n_jobs=1: o cálculo em segundo plano não deve disputar todos os núcleos com as requisições
+            try:
+                versao_historico = obter_versao_historico(item['id'], conn)
+                execucao_unica_previsoes.executar(('previsao', item['id'], versao_historico), calcular_e_salvar_previsao,
+                                                  item['id'], conn, n_jobs=1)
+                recalculadas += 1
+            except ServidorOcupado:
+                logging.info("Agendador de previsões: pool ocupado, restante fica para a próxima rodada.")
+                evento_recalcular_previsoes.set() # Tentar de novo logo, sem esperar o intervalo todo
+                break
+            except FuturesTimeoutError:
+                logging.warning(f"Agendador de previsões: tempo limite excedido para o item {item['id']}.")
+        if recalculadas:
+            logging.info(f"Agendador de previsões: {recalculadas} previsões recalculadas.")
+        return recalculadas
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB no agendador de previsões: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def _loop_agendador_previsoes():
+    while True:
+        try:
+            recalcular_previsoes_obsoletas()
+        except Exception as e:
+            logging.error(f"Erro inesperado no agendador de previsões: {e}\n{traceback.format_exc()}")
+        evento_recalcular_previsoes.wait(INTERVALO_AGENDADOR_PREVISOES)
+        evento_recalcular_previsoes.clear()
+
+# Inicia a thread (daemon) que mantém a tabela 'previsao' atualizada
+def iniciar_agendador_previsoes():
+    thread = threading.Thread(target=_loop_agendador_previsoes, name='agendador-previsoes', daemon=True)
+    thread.start()
+    logging.info(f"Agendador de previsões iniciado (intervalo máximo: {INTERVALO_AGENDADOR_PREVISOES}s).")
+    return thread
+
+# Remove do disco os modelos treinados com um histórico que não é mais o atual
+def podar_modelos_em_disco():
+    repositorio = getattr(helper_module, 'repositorio_modelos', None)
+    if repositorio is None:
+        return
+    conn = get_db_connection()
+    if not conn:
+        logging.error("Falha na conexão com DB, modelos em disco não foram verificados.")
+        return
+    try:
+        removidos = repositorio.podar(obter_versoes_historico_todos(conn))
+        logging.info(f"Modelos em disco verificados: {removidos} modelos obsoletos removidos.")
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB ao verificar modelos em disco: {e}")
+    finally:
+        conn.close()
 
 # === ROTA DA API DE PREVISÃO (ESSENCIAL) ===
 @app.route('/api/prever/<int:item_id>')
 def api_prever_consumo(item_id):
     logging.info(f"Acessando API /api/prever/{item_id}")
+    orcamento = ORCAMENTO_LATENCIA_PREVISAO
+    if 'orcamento' in request.args:
+        orcamento = request.args.get('orcamento', type=float)
+        if orcamento is None or orcamento < 0:
+            return jsonify(message='Orçamento de latência inválido (esperado um número de segundos >= 0).'), 400
     conn = get_db_connection()
     if not conn: return jsonify(message='Erro interno: Falha ao conectar ao banco de dados.'), 500
 
     item_info = None
-    df_consumo = None
     try:
         # 1. Buscar informações básicas do item
         item_info = conn.execute('SELECT nome, quantidade FROM estoque WHERE id = ?', (item_id,)).fetchone()
@@ -200,16 +950,45 @@ def api_prever_consumo(item_id):
             logging.warning(f"API /api/prever: Item com ID {item_id} não encontrado no estoque.")
             return jsonify(message=f'Item com ID {item_id} não encontrado.'), 404
 
-        # 2. Buscar histórico de consumo
-        df_consumo = fetch_consumo_data_for_prediction(item_id, conn)
-        if df_consumo is None: # Erro já logado na função auxiliar
-             return jsonify(message='Erro interno ao buscar histórico de consumo.'), 500
-
-        # 3. Chamar a função de previsão do helper_module
-        logging.debug(f"Chamando helper_module.obter_previsao_sklearn para item {item_id} ({item_info['nome']}) com {len(df_consumo)} registros históricos.")
-        resultado_previsao = helper_module.obter_previsao_sklearn(df_consumo) # Passa o DataFrame
+        # 2. Ler a previsão pré-calculada; se ausente ou obsoleta, calcular agora (e gravar)
+        versao_historico = obter_versao_historico(item_id, conn)
+        resultado_previsao = None
+        estado_previsao = 'fresca'
+        if USAR_PREVISAO_INCREMENTAL and versao_historico:
+            resultado_previsao = obter_previsao_incremental(item_id, versao_historico, conn)
+        if resultado_previsao is None and versao_historico:
+            resultado_previsao = buscar_previsao_armazenada(item_id, versao_historico, conn)
+        if resultado_previsao is None and versao_historico and orcamento is not None:
+            # Espera o cálculo só até o orçamento; depois responde com a substituta e o cálculo segue
+            futuro = agendar_atualizacao_previsao(item_id, versao_historico)
+            try:
+                resultado_previsao = futuro.result(timeout=orcamento)
+            except Exception: # Tempo esgotado (ou erro, já logado ao concluir): usar a substituta
+                resultado_previsao = None
+            if resultado_previsao is None:
+                logging.info(f"API /api/prever/{item_id}: previsão completa não ficou pronta em {orcamento}s. Respondendo com a substituta.")
+                resultado_previsao, estado_previsao = buscar_previsao_substituta(item_id, conn)
+                if resultado_previsao is None:
+                    return jsonify(message='Erro interno ao buscar histórico de consumo.'), 500
+            else:
+                resultado_previsao = dict(resultado_previsao) # O futuro pode ser compartilhado com outras requisições
+        if resultado_previsao is None:
+            logging.debug(f"API /api/prever: Sem previsão atualizada gravada para item {item_id}. Calculando.")
+            try:
+                resultado_previsao = execucao_unica_previsoes.executar(('previsao', item_id, versao_historico),
+                                                                       calcular_e_salvar_previsao, item_id, conn)
+            except ServidorOcupado:
+                logging.warning(f"API /api/prever/{item_id}: fila de previsões cheia.")
+                return resposta_servidor_ocupado()
+            except FuturesTimeoutError:
+                logging.warning(f"API /api/prever/{item_id}: tempo limite de {TIMEOUT_PREVISAO}s excedido.")
+                return jsonify(message=f'A previsão do item {item_id} demorou mais que {TIMEOUT_PREVISAO}s. Tente novamente em instantes.'), 504
+            if resultado_previsao is None: # Erro já logado nas funções auxiliares
+                return jsonify(message='Erro interno ao buscar histórico de consumo.'), 500
+            resultado_previsao = dict(resultado_previsao) # Compartilhado com as requisições agrupadas
 
-        # 4. Adicionar info do item ao resultado e logar
+        # 3. Adicionar estado, idade e info do item ao resultado e logar
+        marcar_estado_previsao(resultado_previsao, estado_previsao)
         resultado_previsao['item_id'] = item_id
         resultado_previsao['nome_item'] = item_info['nome']
         resultado_previsao['estoque_atual'] = item_info['quantidade']
@@ -224,6 +1003,326 @@ def api_prever_consumo(item_id):
         if conn: conn.close()
 # === FIM DA ROTA DA API DE PREVISÃO ===
 
+@app.route('/api/prever/lote')
+def api_prever_lote():
+    modo = request.args.get('modo', MODO_PREVISAO_LOTE)
+    logging.info(f"Acessando API /api/prever/lote (modo: {modo})")
+    if modo not in MODOS_PREVISAO_LOTE:
+        return jsonify(message=f'Modo de previsão inválido: "{modo}". Use um de: {", ".join(MODOS_PREVISAO_LOTE)}.'), 400
+    conn = get_db_connection()
+    if not conn: return jsonify(message='Erro interno: Falha ao conectar ao banco de dados.'), 500
+    try:
+        # 1. Itens e histórico de todos eles (uma consulta cada)
+        itens = [dict(row) for row in conn.execute('SELECT id, nome, quantidade FROM estoque ORDER BY nome COLLATE NOCASE').fetchall()]
+        versoes = obter_versoes_historico_todos(conn)
+        df_todos = fetch_consumo_data_lote(conn)
+        if df_todos is None:
+            return jsonify(message='Erro interno ao buscar histórico de consumo.'), 500
+        modelos_selecionados = obter_modelos_selecionados(conn)
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB em API /api/prever/lote: {e}")
+        return jsonify(message=f'Erro ao buscar dados de estoque: {e}'), 500
+    finally:
+        conn.close() # O treinamento não precisa da conexão
+
+    # 2. Separar os totais diários por item
+    historicos = {item_id: df_item[['dia', 'quantidade']].reset_index(drop=True)
+                  for item_id, df_item in df_todos.groupby('item_id', sort=False)}
+    df_vazio = df_todos[['dia', 'quantidade']].iloc[0:0]
+
+    inicio = time.perf_counter()
+    if modo == 'global':
+        # 3a. Um único modelo para todos os itens
+        try:
+            previsoes = executar_previsao(
+                helper_module.obter_previsoes_globais,
+                {item['id']: historicos.get(item['id'], df_vazio) for item in itens},
+                versoes={item['id']: versoes.get(item['id'], formatar_versao_historico(0, None)) for item in itens},
+                n_jobs=MAX_WORKERS_PREVISAO_LOTE)
+        except ServidorOcupado:
+            return resposta_servidor_ocupado()
+        except FuturesTimeoutError:
+            return jsonify(message=f'A previsão em lote demorou mais que {TIMEOUT_PREVISAO}s. Tente novamente em instantes.'), 504
+        except Exception as e:
+            logging.error(f"Erro inesperado na previsão em lote (modo global): {e}\n{traceback.format_exc()}")
+            return jsonify(message='Erro inesperado no servidor ao gerar previsões. Verifique os logs.'), 500
+        resultados = []
+        for item in itens:
+            resultado = previsoes[item['id']]
+            resultado['item_id'] = item['id']
+            resultado['nome_item'] = item['nome']
+            resultado['estoque_atual'] = item['quantidade']
+            resultados.append(resultado)
+    else:
+        # 3b. Um modelo por item, no pool limitado
+        futuros = [
+            executor_previsao_lote.submit(_prever_item_lote, item, historicos.get(item['id'], df_vazio),
+                                          versoes.get(item['id'], formatar_versao_historico(0, None)),
+                                          modelos_selecionados.get(item['id']))
+            for item in itens
+        ]
+        resultados = [futuro.result() for futuro in futuros]
+    logging.info(f"Previsão em lote (modo {modo}) concluída para {len(resultados)} itens em {time.perf_counter() - inicio:.2f}s.")
+    return jsonify(resultados)
+
+# --- JOBS DE PREVISÃO (RESULTADOS PROGRESSIVOS VIA SSE) ---
+
+class JobPrevisoes:
+    """Previsões de um conjunto de itens; os resultados entram na ordem em que ficam prontos."""
+    def __init__(self, itens):
+        self.id = uuid.uuid4().hex
+        self.itens = itens
+        self.resultados = []
+        self.criado_em = time.time()
+        self.concluido_em = None if itens else self.criado_em
+        self._condicao = threading.Condition()
+
+    @property
+    def concluido(self):
+        return self.concluido_em is not None
+
+    def adicionar(self, resultado):
+        with self._condicao:
+            self.resultados.append(resultado)
+            if len(self.resultados) == len(self.itens):
+                self.concluido_em = time.time()
+            self._condicao.notify_all()
+
+    def aguardar(self, desde, timeout):
+        """Espera haver resultados além dos `desde` primeiros; retorna (novos, concluído)."""
+        with self._condicao:
+            self._condicao.wait_for(lambda: len(self.resultados) > desde or self.concluido, timeout)
+            return self.resultados[desde:], self.concluido
+
+    def resumo(self):
+        return {'job_id': self.id, 'total': len(self.itens), 'concluidos': len(self.resultados), 'concluido': self.concluido,
+                'itens': [{'id': item['id'], 'nome': item['nome']} for item in self.itens],
+                'stream_url': url_for('api_stream_job_previsoes', job_id=self.id)}
+
+jobs_previsao = {}
+_lock_jobs_previsao = threading.Lock()
+
+# Remove jobs concluídos há mais de RETENCAO_JOBS_PREVISAO segundos e os mais antigos além de MAX_JOBS_PREVISAO
+def _podar_jobs_previsao():
+    agora = time.time()
+    with _lock_jobs_previsao:
+        concluidos = sorted((job for job in jobs_previsao.values() if job.concluido), key=lambda job: job.concluido_em)
+        excedentes = max(0, len(jobs_previsao) - MAX_JOBS_PREVISAO)
+        for indice, job in enumerate(concluidos):
+            if indice < excedentes or agora - job.concluido_em > RETENCAO_JOBS_PREVISAO:
+                del jobs_previsao[job.id]
+
+# Previsão de um item para um job: gravada e atualizada, ou calculada (e gravada) agora.
+# Nunca levanta exceção: erros vão no campo 'erro', como na previsão em lote.
+def _prever_item_job(item):
+    conn = get_db_connection()
+    try:
+        if not conn:
+            raise sqlite3.OperationalError('Falha ao conectar ao banco de dados.')
+        versao_historico = obter_versao_historico(item['id'], conn)
+        resultado = None
+        if USAR_PREVISAO_INCREMENTAL and versao_historico:
+            resultado = obter_previsao_incremental(item['id'], versao_historico, conn)
+        if resultado is None and versao_historico:
+            resultado = buscar_previsao_armazenada(item['id'], versao_historico, conn)
+        if resultado is None:
+            # Como no lote: o resultado fica gravado no job (ou no stream), então uma fila
+            # momentaneamente cheia não deve virar erro do item
+            resultado = execucao_unica_previsoes.executar(('previsao', item['id'], versao_historico), calcular_e_salvar_previsao,
+                                                          item['id'], conn, n_jobs=1, espera_vaga=TIMEOUT_PREVISAO)
+        if resultado is None: # Erro já logado nas funções auxiliares
+            resultado = {'previsao': None, 'erro': 'Erro interno ao buscar histórico de consumo.'}
+        else:
+            resultado = marcar_estado_previsao(dict(resultado), 'fresca')
+    except ServidorOcupado:
+        resultado = {'previsao': None, 'erro': 'Servidor ocupado. Tente novamente em instantes.'}
+    except FuturesTimeoutError:
+        resultado = {'previsao': None, 'erro': f'Tempo limite ({TIMEOUT_PREVISAO}s) excedido ao prever o item.'}
+    except Exception as e:
+        logging.error(f"Erro inesperado na previsão do item {item['id']} (job): {e}\n{traceback.format_exc()}")
+        resultado = {'previsao': None, 'erro': f'Erro inesperado no servidor ao prever item {item["id"]}.'}
+    finally:
+        if conn: conn.close()
+    resultado['item_id'] = item['id']
+    resultado['nome_item'] = item['nome']
+    resultado['estoque_atual'] = item['quantidade']
+    return resultado
+
+@app.route('/api/previsoes/jobs', methods=['POST'])
+def api_criar_job_previsoes():
+    logging.info("Recebida requisição POST em /api/previsoes/jobs")
+    dados = request.get_json(silent=True)
+    if dados is None:
+        dados = {} # Sem corpo (ou sem JSON): todos os itens
+    if not isinstance(dados, dict):
+        return jsonify(message='O corpo deve ser um objeto JSON, e.g. {"itens": [1, 2]}.'), 400
+    ids = dados.get('itens')
+    if ids is not None and (not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+        return jsonify(message='"itens" deve ser uma lista de IDs (inteiros) ou ausente (todos os itens).'), 400
+    conn = get_db_connection()
+    if not conn: return jsonify(message='Erro interno: Falha ao conectar ao banco de dados.'), 500
+    try:
+        itens = [dict(row) for row in conn.execute('SELECT id, nome, quantidade FROM estoque ORDER BY nome COLLATE NOCASE').fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Erro DB em /api/previsoes/jobs: {e}")
+        return jsonify(message=f'Erro ao buscar dados de estoque: {e}'), 500
+    finally:
+        conn.close()
+    nao_encontrados = []
+    if ids is not None:
+        selecionados = set(ids)
+        nao_encontrados = sorted(selecionados - {item['id'] for item in itens})
+        itens = [item for item in itens if item['id'] in selecionados]
+
+    _podar_jobs_previsao()
+    job = JobPrevisoes(itens)
+    with _lock_jobs_previsao:
+        jobs_previsao[job.id] = job
+    for item in itens:
+        executor_previsao_lote.submit(_prever_item_job, item).add_done_callback(lambda futuro: job.adicionar(futuro.result()))
+    logging.info(f"Job de previsões {job.id} criado com {len(itens)} itens.")
+    return jsonify(dict(job.resumo(), nao_encontrados=nao_encontrados)), 202
+
+def _obter_job_previsoes(job_id):
+    with _lock_jobs_previsao:
+        return jobs_previsao.get(job_id)
+
+@app.route('/api/previsoes/jobs/<job_id>')
+def api_status_job_previsoes(job_id):
+    job = _obter_job_previsoes(job_id)
+    if job is None:
+        return jsonify(message=f'Job {job_id} não encontrado (ou já expirado).'), 404
+    return jsonify(dict(job.resumo(), resultados=job.resultados))
+
+def _evento_sse(evento, dados, id_evento=None):
+    linhas = [f'id: {id_evento}'] if id_evento is not None else []
+    linhas += [f'event: {evento}', f'data: {json.dumps(dados, ensure_ascii=False)}']
+    return '\n'.join(linhas) + '\n\n'
+
+# Stream (Server-Sent Events) dos resultados do job: um evento 'resultado' por item, na ordem
+# em que ficam prontos, e um 'fim' no final. O id de cada evento é a posição do resultado, então
+# o EventSource que reconectar (cabeçalho Last-Event-ID) recebe só o que ainda não tinha recebido;
+# em um job já concluído os resultados vêm direto da memória, sem recalcular nada.
+@app.route('/api/previsoes/jobs/<job_id>/stream')
+def api_stream_job_previsoes(job_id):
+    job = _obter_job_previsoes(job_id)
+    if job is None:
+        return jsonify(message=f'Job {job_id} não encontrado (ou já expirado).'), 404
+    try:
+        enviados = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        enviados = 0
+    logging.info(f"Stream do job de previsões {job_id} (a partir do resultado {enviados}).")
+
+    def gerar():
+        nonlocal enviados
+        yield 'retry: 3000\n\n'
+        while True:
+            novos, concluido = job.aguardar(enviados, INTERVALO_HEARTBEAT_SSE)
+            for resultado in novos:
+                yield _evento_sse('resultado', resultado, enviados)
+                enviados += 1
+            if concluido and enviados >= len(job.itens):
+                yield _evento_sse('fim', {'job_id': job.id, 'total': len(job.itens)})
+                return
+            if not novos:
+                yield ': keep-alive\n\n'
+
+    return Response(gerar(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- PREVISÃO EM LOTE POR STREAM NDJSON ---
+
+# Ordem dos itens do stream, do mais barato ao mais caro de prever: primeiro os que já têm
+# previsão gravada não obsoleta, depois pelo número de dias do histórico (séries curtas vão
+# para a camada rápida; as longas treinam a floresta com mais linhas). A ordem é calculada uma
+# vez, em uma tabela TEMP da conexão do stream (fica no SQLite, não na memória do Python).
+SQL_ORDEM_CUSTO_PREVISAO = '''
+    INSERT INTO temp.ordem_previsao (item_id, custo)
+    SELECT e.id,
+           CASE WHEN p.obsoleta = 0 THEN 0
+                ELSE 1 + COALESCE((SELECT MAX(dia) FROM consumo_diario WHERE item_id = e.id)
+                                  - (SELECT MIN(dia) FROM consumo_diario WHERE item_id = e.id) + 1, 0)
+           END AS custo
+    FROM estoque e LEFT JOIN previsao p ON p.item_id = e.id AND p.horizonte = ?
+    ORDER BY custo, e.id
+'''
+
+def _paginas_itens_por_custo(conn):
+    with conn:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS ordem_previsao (ordem INTEGER PRIMARY KEY, item_id INTEGER NOT NULL, custo INTEGER NOT NULL)')
+        conn.execute('DELETE FROM temp.ordem_previsao')
+        conn.execute(SQL_ORDEM_CUSTO_PREVISAO, (HORIZONTE_PREVISAO,))
+    ultima_ordem = 0
+    while True:
+        # Cada página é lida por inteiro (sem cursor aberto entre páginas, que seguraria o banco);
+        # itens excluídos no meio do stream somem pelo JOIN
+        pagina = [dict(row) for row in conn.execute('''
+            SELECT o.ordem, e.id, e.nome, e.quantidade FROM temp.ordem_previsao o JOIN estoque e ON e.id = o.item_id
+            WHERE o.ordem > ? ORDER BY o.ordem LIMIT ?
+        ''', (ultima_ordem, TAMANHO_PAGINA_NDJSON)).fetchall()]
+        if not pagina:
+            return
+        ultima_ordem = pagina[-1]['ordem']
+        yield pagina
+
+# Previsão de todos os itens em uma única resposta NDJSON (uma linha JSON por item, na ordem
+# em que ficam prontas). Os itens entram no pool da previsão em lote do mais barato ao mais caro,
+# com no máximo MAX_EM_ANDAMENTO_NDJSON em andamento: o cálculo dos próximos se sobrepõe ao
+# envio dos já prontos e nada se acumula no servidor.
+@app.route('/api/prever/lote/ndjson')
+def api_prever_lote_ndjson():
+    logging.info("Acessando API /api/prever/lote/ndjson")
+    conn = get_db_connection()
+    if not conn: return jsonify(message='Erro interno: Falha ao conectar ao banco de dados.'), 500
+
+    def gerar():
+        pendentes = set()
+        enviados = 0
+        inicio = time.perf_counter()
+        try:
+            for pagina in _paginas_itens_por_custo(conn):
+                for item in pagina:
+                    pendentes.add(executor_previsao_lote.submit(_prever_item_job, item))
+                    while len(pendentes) >= MAX_EM_ANDAMENTO_NDJSON:
+                        prontos, pendentes = aguardar_futuros(pendentes, return_when=FIRST_COMPLETED)
+                        for futuro in prontos:
+                            yield json.dumps(futuro.result(), ensure_ascii=False) + '\n'
+                            enviados += 1
+            while pendentes:
+                prontos, pendentes = aguardar_futuros(pendentes, return_when=FIRST_COMPLETED)
+                for futuro in prontos:
+                    yield json.dumps(futuro.result(), ensure_ascii=False) + '\n'
+                    enviados += 1
+            logging.info(f"Previsão em lote (NDJSON) concluída para {enviados} itens em {time.perf_counter() - inicio:.2f}s.")
+        except sqlite3.Error as e:
+            logging.error(f"Erro DB em API /api/prever/lote/ndjson: {e}")
+            yield json.dumps({'erro': f'Erro ao buscar dados de estoque: {e}'}, ensure_ascii=False) + '\n'
+        finally:
+            # Cliente desconectou (ou erro): não iniciar as previsões que ainda estão na fila
+            for futuro in pendentes:
+                futuro.cancel()
+            conn.close()
+
+    return Response(gerar(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/metricas')
+def api_metricas():
+    logging.info("Acessando API /api/metricas")
+    cache = getattr(helper_module, 'cache_modelos', None)
+    repositorio = getattr(helper_module, 'repositorio_modelos', None)
+    governador = getattr(helper_module, 'governador_paralelismo', None)
+    # Cache e repositório: contadores deste processo somados aos dos processos do pool;
+    # o governador já é compartilhado com eles
+    estatisticas_cache = _somar_metricas_processos(cache.estatisticas(), 'cache_modelos') if cache else None
+    estatisticas_repositorio = _somar_metricas_processos(repositorio.estatisticas(), 'repositorio_modelos') if repositorio else None
+    return jsonify(cache_modelos=estatisticas_cache,
+                   repositorio_modelos=estatisticas_repositorio,
+                   governador_paralelismo=governador.estatisticas() if governador else None,
+                   execucao_unica=execucao_unica_previsoes.estatisticas(),
+                   pool_previsoes=dict(metricas_pool_previsoes, ativo=USAR_POOL_PROCESSOS, processos=MAX_PROCESSOS_PREVISAO,
+                                       fila_maxima=MAX_FILA_PREVISAO))
+
 # --- ROTAS DE AÇÃO (POST) ---
 
 @app.route('/adicionar', methods=['POST'])
@@ -283,11 +1382,16 @@ def consumir_item(item_id):
                 return jsonify(message='Item fora de estoque.'), 400
 
             cursor.execute('UPDATE estoque SET quantidade = quantidade - 1 WHERE id = ?', (item_id,))
-            data_consumo_iso = datetime.now().isoformat(timespec='seconds')
-            cursor.execute('INSERT INTO consumo (item_id, quantidade, data_consumo) VALUES (?, ?, ?)',
-                           (item_id, 1, data_consumo_iso))
+            agora = datetime.now().replace(microsecond=0)
+            data_consumo_epoch, dia_consumo = tempo_consumo(agora)
+            cursor.execute('INSERT INTO consumo (item_id, quantidade, data_consumo, data_consumo_epoch, dia_consumo) VALUES (?, ?, ?, ?, ?)',
+                           (item_id, 1, agora.isoformat(timespec='seconds'), data_consumo_epoch, dia_consumo))
+            if USAR_PREVISAO_INCREMENTAL:
+                registrar_consumo_incremental(item_id, cursor.lastrowid, dia_consumo, 1, conn)
+            marcar_previsao_obsoleta(item_id, conn)
             cursor.execute('SELECT quantidade FROM estoque WHERE id = ?', (item_id,))
             nova_quantidade = cursor.fetchone()['quantidade']
+        evento_recalcular_previsoes.set()
 
         logging.info(f"Item ID {item_id} ({item['nome']}) consumido. Nova quantidade: {nova_quantidade}")
         return jsonify(message='Item consumido com sucesso', nova_quantidade=nova_quantidade), 200
@@ -330,6 +1434,8 @@ def editar_item(item_id):
             if res.rowcount == 0:
                  logging.warning(f"Tentativa de editar item inexistente: ID {item_id}")
                  return jsonify(message='Item não encontrado para editar.'), 404
+            marcar_previsao_obsoleta(item_id, conn)
+        evento_recalcular_previsoes.set()
 
         logging.info(f"Item ID {item_id} editado para nome='{nome}', quantidade={quantidade}")
         return jsonify(message='Item editado com sucesso')
@@ -393,11 +1499,38 @@ def bad_request_error(error):
     return jsonify(message=f"Requisição inválida: {desc}"), 400
 
 # --- INICIALIZAÇÃO ---
+# --- INICIALIZAÇÃO ---
+# Banco, poda dos modelos em disco e agendador são preparados na primeira requisição, o que vale
+# também para `flask run` e servidores WSGI (que não executam o bloco __main__). Com o reloader
+# do modo debug, só o processo que atende as requisições chega aqui. Em testes (app.testing)
+# o agendador não é iniciado.
+_aplicacao_inicializada = False
+_lock_inicializacao = threading.Lock()
+
+@app.before_request
+def inicializar_aplicacao():
+    global _aplicacao_inicializada
+    if _aplicacao_inicializada:
+        return
+    with _lock_inicializacao:
+        if _aplicacao_inicializada:
+            return
+        logging.info("=== INICIALIZANDO APLICAÇÃO ===")
+        init_db()
+        podar_modelos_em_disco()
+        if not app.testing:
+            iniciar_agendador_previsoes()
+        _aplicacao_inicializada = True
+
 if __name__ == '__main__':
-    logging.info("=== INICIALIZANDO APLICAÇÃO ===")
-    init_db()
+    # Modo debug pela variável FLASK_DEBUG, como no `flask run` (sem a variável, ligado)
+    app.debug = os.environ.get('FLASK_DEBUG', '1').lower() not in ('0', 'false', 'no')
+    # Com o reloader do modo debug este bloco roda em dois processos; a inicialização (e o
+    # agendador) só deve rodar no processo que atende as requisições. Sem debug há um só processo.
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        inicializar_aplicacao()
     logging.info(f"Iniciando servidor Flask em modo {'DEBUG' if app.debug else 'PRODUÇÃO'}...")
     # Use host='0.0.0.0' para acessível na rede, port pode ser alterado
-    app.run(debug=True, host='127.0.0.1', port=5000, use_reloader=True) # use_reloader=True é padrão com debug=True
+    app.run(debug=app.debug, host='127.0.0.1', port=5000, use_reloader=app.debug) # use_reloader=True é padrão com debug=True
 
 # --- END OF FILE app.py ---
\ No newline at end of file
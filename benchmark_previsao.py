@@ -0,0 +1,276 @@
+# --- START OF FILE benchmark_previsao.py ---
+"""
+Benchmark do motor de previsão com históricos sintéticos.
+
+Gera, para cada caso (número de itens x dias de histórico x esparsidade), um banco
+SQLite temporário com consumos sintéticos e mede, item a item, o tempo de cada
+etapa da previsão por RandomForest: busca no banco (totais diários, direto em arrays
+NumPy), preenchimento dos dias sem consumo, engenharia de features, treino e previsão
+(com o predict do sklearn e com a floresta exportada para arrays planos, incluindo a
+exportação, conferindo que as duas previsões são iguais). Também mede a requisição
+completa (/api/prever/<id>, pelo cliente de teste do Flask, sem cache nem
+previsões gravadas) e o pico de memória Python dela (tracemalloc; não inclui
+alocações internas das extensões C que não passam pelo alocador do Python).
+
+Roda offline, sem servidor e sem tocar em database.db. O resultado é um JSON.
+
+Uso:
+    python benchmark_previsao.py                      # grade padrão, JSON no terminal
+    python benchmark_previsao.py --rapido --saida resultado.json
+    python benchmark_previsao.py --itens 10 --dias 30 365 1825 --esparsidade 0 0.5 0.9
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+import app as aplicacao
+import helper_module
+
+ITENS_PADRAO = [5, 20]
+DIAS_PADRAO = [30, 180, 730, 1825] # De um mês a cinco anos de histórico
+ESPARSIDADE_PADRAO = [0.2, 0.8] # Fração esperada de dias sem consumo
+CONSUMOS_POR_DIA = 3 # Média de consumos (de 1 unidade) em um dia com consumo
+HORIZONTE = 7
+SEMENTE = 42
+
+ETAPAS = ('busca', 'agregacao_diaria', 'features', 'treino', 'previsao', 'previsao_plana')
+
+# --- Dados sintéticos ---
+
+def gerar_consumos(rng, dias, esparsidade, fim):
+    """
+    Gera os consumos de um item: em cada dia, com probabilidade 1 - esparsidade,
+    um número Poisson de consumos (cada um uma linha de quantidade 1, como em /consumir)
+    em horários aleatórios. Inclui sazonalidade semanal para o modelo ter o que aprender.
+
+    Returns:
+        list: Tuplas (data_consumo ISO, data_consumo_epoch, dia_consumo, quantidade), em ordem cronológica.
+    """
+    inicio = fim - timedelta(days=dias - 1)
+    dias_semana = (np.arange(dias) + inicio.weekday()) % 7
+    taxa = CONSUMOS_POR_DIA * np.where(dias_semana >= 5, 1.5, 1.0)
+    ativos = rng.random(dias) >= esparsidade
+    contagens = np.where(ativos, np.maximum(1, rng.poisson(taxa)), 0)
+
+    consumos = []
+    for dia in np.flatnonzero(contagens):
+        data_dia = inicio + timedelta(days=int(dia))
+        for segundos in np.sort(rng.integers(0, 86400, size=contagens[dia])):
+            data_hora = data_dia + timedelta(seconds=int(segundos))
+            consumos.append((data_hora.isoformat(timespec='seconds'), *aplicacao.tempo_consumo(data_hora), 1))
+    return consumos
+
+def criar_banco_sintetico(caminho, n_itens, dias, esparsidade, semente=SEMENTE):
+    """Cria o banco em `caminho` com o schema da aplicação e `n_itens` itens sintéticos."""
+    aplicacao.DATABASE = caminho
+    aplicacao.init_db()
+    rng = np.random.default_rng(semente)
+    fim = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    conn = sqlite3.connect(caminho)
+    total_consumos = 0
+    try:
+        with conn:
+            for i in range(n_itens):
+                cursor = conn.execute('INSERT INTO estoque (nome, quantidade, data_cadastro) VALUES (?, ?, ?)',
+                                      (f'Item {i + 1}', 100, fim.strftime('%Y-%m-%d')))
+                item_id = cursor.lastrowid
+                consumos = gerar_consumos(rng, dias, esparsidade, fim)
+                conn.executemany('INSERT INTO consumo (item_id, quantidade, data_consumo, data_consumo_epoch, dia_consumo) VALUES (?, ?, ?, ?, ?)',
+                                 ((item_id, quantidade, data, epoch, dia) for data, epoch, dia, quantidade in consumos))
+                total_consumos += len(consumos)
+    finally:
+        conn.close()
+    return total_consumos
+
+# --- Medição ---
+
+def _resumo(tempos):
+    tempos = np.asarray(tempos, dtype=float)
+    if len(tempos) == 0:
+        return {'itens': 0, 'total_s': 0.0, 'media_ms': None, 'mediana_ms': None, 'maximo_ms': None}
+    return {
+        'itens': len(tempos),
+        'total_s': round(float(tempos.sum()), 4),
+        'media_ms': round(float(tempos.mean()) * 1000, 3),
+        'mediana_ms': round(float(np.median(tempos)) * 1000, 3),
+        'maximo_ms': round(float(tempos.max()) * 1000, 3),
+    }
+
+def medir_etapas_item(item_id, conn, lag_max=7, janela_movel=7):
+    """
+    Executa, para um item, as etapas do caminho RandomForest de `obter_previsao_arrays`
+    uma a uma (sem cache e sem camada rápida), cronometrando cada uma.
+
+    Returns:
+        dict: etapa -> segundos (etapas não executadas ficam de fora), 'linhas_treino' e
+              'diferenca_plana' (maior diferença diária entre o sklearn e a FlorestaPlana).
+    """
+    tempos = {}
+    t0 = time.perf_counter()
+    historico = aplicacao.fetch_consumo_data_for_prediction(item_id, conn)
+    tempos['busca'] = time.perf_counter() - t0
+    if historico is None or len(historico[0]) == 0:
+        return tempos
+
+    # A busca já devolve números de dia inteiros (totais de 'consumo_diario'): não há
+    # conversão de datas, só o preenchimento dos dias sem consumo
+    t0 = time.perf_counter()
+    valores, dia_inicial = helper_module.valores_diarios_de_arrays(*historico)
+    tempos['agregacao_diaria'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    matriz, _ = helper_module.criar_features_temporais_np(valores, dia_inicial, lag_max=lag_max, janela_movel=janela_movel)
+    tempos['features'] = time.perf_counter() - t0
+    tempos['linhas_treino'] = len(matriz)
+    if len(matriz) < 10:
+        return tempos
+
+    t0 = time.perf_counter()
+    modelo = helper_module.treinar_modelo(helper_module.criar_regressor('random_forest'), matriz[:, 1:], matriz[:, 0], n_jobs=1)
+    tempos['treino'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    buffer = helper_module.BufferFeaturesRecursivas(matriz[:, 0], lag_max=lag_max, janela_movel=janela_movel)
+    previsoes = buffer.prever(modelo, dia_inicial + len(valores) - 1, HORIZONTE)
+    tempos['previsao'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    floresta = helper_module.FlorestaPlana.de_floresta(modelo)
+    buffer = helper_module.BufferFeaturesRecursivas(matriz[:, 0], lag_max=lag_max, janela_movel=janela_movel)
+    previsoes_planas = buffer.prever(floresta, dia_inicial + len(valores) - 1, HORIZONTE)
+    tempos['previsao_plana'] = time.perf_counter() - t0
+    tempos['diferenca_plana'] = float(np.max(np.abs(np.subtract(previsoes, previsoes_planas)), initial=0.0))
+    return tempos
+
+def _preparar_calculo_completo():
+    """Esvazia o cache de modelos e as previsões gravadas, forçando o cálculo completo."""
+    helper_module.cache_modelos.limpar()
+    conn = sqlite3.connect(aplicacao.DATABASE)
+    with conn:
+        conn.execute('DELETE FROM previsao')
+    conn.close()
+
+def medir_requisicoes(cliente, itens_ids):
+    """
+    Chama /api/prever/<id> para cada item com cálculo completo (sem cache nem previsões
+    gravadas), medindo o tempo de cada requisição. O pico de memória é medido em uma
+    segunda rodada, sob tracemalloc, para o rastreamento não distorcer os tempos.
+    """
+    _preparar_calculo_completo()
+    tempos = []
+    metodos = {}
+    for item_id in itens_ids:
+        t0 = time.perf_counter()
+        resposta = cliente.get(f'/api/prever/{item_id}')
+        tempos.append(time.perf_counter() - t0)
+        metodo = (resposta.get_json() or {}).get('metodo', f'HTTP {resposta.status_code}')
+        metodos[metodo] = metodos.get(metodo, 0) + 1
+
+    _preparar_calculo_completo()
+    tracemalloc.start()
+    try:
+        for item_id in itens_ids:
+            cliente.get(f'/api/prever/{item_id}')
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'tempo': _resumo(tempos), 'pico_memoria_mb': round(pico / 2**20, 2), 'metodos': metodos}
+
+def executar_caso(n_itens, dias, esparsidade, diretorio):
+    caminho = os.path.join(diretorio, f'bench_{n_itens}_{dias}_{esparsidade}.db')
+    t0 = time.perf_counter()
+    total_consumos = criar_banco_sintetico(caminho, n_itens, dias, esparsidade)
+    tempo_geracao = time.perf_counter() - t0
+
+    conn = aplicacao.get_db_connection()
+    try:
+        itens_ids = [row['id'] for row in conn.execute('SELECT id FROM estoque ORDER BY id')]
+        medicoes = [medir_etapas_item(item_id, conn) for item_id in itens_ids]
+    finally:
+        conn.close()
+
+    etapas = {etapa: _resumo([m[etapa] for m in medicoes if etapa in m]) for etapa in ETAPAS}
+    requisicoes = medir_requisicoes(aplicacao.app.test_client(), itens_ids)
+    os.remove(caminho)
+    return {
+        'itens': n_itens,
+        'dias_historico': dias,
+        'esparsidade': esparsidade,
+        'consumos': total_consumos,
+        'linhas_treino_media': round(float(np.mean([m.get('linhas_treino', 0) for m in medicoes])), 1),
+        'diferenca_maxima_floresta_plana': max((m['diferenca_plana'] for m in medicoes if 'diferenca_plana' in m), default=None),
+        'geracao_dados_s': round(tempo_geracao, 4),
+        'etapas': etapas,
+        'requisicao_completa': requisicoes,
+    }
+
+def configurar_aplicacao():
+    """
+    Isola a aplicação: previsões no próprio processo, sem modelos em disco, sem logs de
+    requisição e sem orçamento de latência (a requisição espera o cálculo completo).
+    """
+    aplicacao.USAR_POOL_PROCESSOS = False
+    aplicacao.ORCAMENTO_LATENCIA_PREVISAO = None
+    helper_module.PERSISTIR_MODELOS = False
+    aplicacao.logging.getLogger().setLevel(aplicacao.logging.WARNING)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark do motor de previsão com históricos sintéticos.')
+    parser.add_argument('--itens', type=int, nargs='+', default=ITENS_PADRAO, help='Números de itens por caso.')
+    parser.add_argument('--dias', type=int, nargs='+', default=DIAS_PADRAO, help='Dias de histórico por item.')
+    parser.add_argument('--esparsidade', type=float, nargs='+', default=ESPARSIDADE_PADRAO,
+                        help='Fração esperada de dias sem consumo (0 a 1).')
+    parser.add_argument('--rapido', action='store_true', help='Grade reduzida (verificação rápida).')
+    parser.add_argument('--saida', help='Arquivo JSON de saída (padrão: imprime no terminal).')
+    args = parser.parse_args(argv)
+    if args.rapido:
+        args.itens, args.dias, args.esparsidade = [3], [30, 365], [0.5]
+
+    configurar_aplicacao()
+    banco_original = aplicacao.DATABASE
+    casos = []
+    with tempfile.TemporaryDirectory(prefix='benchmark_previsao_') as diretorio:
+        try:
+            for n_itens in args.itens:
+                for dias in args.dias:
+                    for esparsidade in args.esparsidade:
+                        print(f"Caso: {n_itens} itens, {dias} dias, esparsidade {esparsidade}...", file=sys.stderr)
+                        casos.append(executar_caso(n_itens, dias, esparsidade, diretorio))
+        finally:
+            aplicacao.DATABASE = banco_original
+
+    resultado = {
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'ambiente': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'nucleos': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__,
+        },
+        'horizonte': HORIZONTE,
+        'casos': casos,
+    }
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(texto)
+        print(f"Resultados gravados em {args.saida}", file=sys.stderr)
+    else:
+        print(texto)
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,794 @@
 
 import pandas as pd
 import numpy as np
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
 # from xgboost import XGBRegressor # Descomente se for usar XGBoost
 # from lightgbm import LGBMRegressor # Descomente se for usar LightGBM
 import traceback # Para imprimir erros detalhados
+import threading
+import time
+import os
+import tempfile
+from contextlib import contextmanager
+import json
+try:
+    import fcntl # Trava de arquivo entre processos (POSIX)
+except ImportError:
+    fcntl = None
+    import msvcrt # Windows
+import platform
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import joblib
+import sklearn
+from threadpoolctl import threadpool_limits
+
+# --- Cache de Modelos Treinados ---
+TAMANHO_MAXIMO_CACHE_MODELOS = 256 # Número máximo de modelos mantidos em memória
+
+class CacheModelos:
+    """
+    Cache LRU (thread-safe) de modelos já treinados.
+
+    A chave deve identificar o item e a versão do seu histórico de consumo
+    (e.g., total de registros + maior `consumo.id`). Enquanto não houver consumo
+    novo, a mesma chave é reutilizada e o `fit()` pode ser pulado.
+    """
+    def __init__(self, tamanho_maximo=TAMANHO_MAXIMO_CACHE_MODELOS):
+        self.tamanho_maximo = tamanho_maximo
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+        self.remocoes = 0
+
+    def obter(self, chave):
+        """Retorna o modelo guardado para a chave (ou None), marcando-o como usado recentemente."""
+        with self._lock:
+            if chave in self._entradas:
+                self._entradas.move_to_end(chave)
+                self.acertos += 1
+                return self._entradas[chave]
+            self.falhas += 1
+            return None
+
+    def guardar(self, chave, modelo):
+        """Guarda o modelo, removendo o menos usado recentemente se o cache estiver cheio."""
+        with self._lock:
+            self._entradas[chave] = modelo
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.tamanho_maximo:
+                self._entradas.popitem(last=False)
+                self.remocoes += 1
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def estatisticas(self):
+        """Retorna contadores de uso do cache (para inspeção/monitoramento)."""
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                'tamanho': len(self._entradas),
+                'tamanho_maximo': self.tamanho_maximo,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'remocoes': self.remocoes,
+                'taxa_acerto': round(self.acertos / total, 4) if total else None,
+            }
+
+cache_modelos = CacheModelos()
+
+# --- Repositório de Modelos em Disco ---
+# Modelos treinados por item são gravados aqui para sobreviver a reinícios da aplicação.
+# Mudar VERSAO_FORMATO_MODELOS invalida (ignora) todos os modelos gravados anteriormente.
+PERSISTIR_MODELOS = True
+DIRETORIO_MODELOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'modelos')
+VERSAO_FORMATO_MODELOS = 1
+
+def _versoes_bibliotecas():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'sklearn': sklearn.__version__, 'joblib': joblib.__version__}
+
+class RepositorioModelos:
+    """
+    Persistência em disco dos modelos treinados (um arquivo por item), em um diretório
+    versionado com um manifesto (`manifesto.json`) que registra, para cada item, a chave
+    do modelo (incluindo a versão do histórico usada no treino) e as versões das
+    bibliotecas. Modelos de outras versões das bibliotecas nunca são carregados.
+
+    Os modelos são carregados sob demanda (na primeira previsão do item), com arrays
+    mapeados em memória quando o formato permite. Como vários processos (pool de
+    previsões) gravam modelos, toda alteração (reler o manifesto, gravar o arquivo do
+    modelo e o manifesto) acontece sob uma trava de arquivo (`manifesto.lock`) entre
+    processos, e cada gravação usa um arquivo temporário próprio antes do os.replace.
+    """
+    def __init__(self, diretorio=DIRETORIO_MODELOS):
+        self.diretorio = os.path.join(diretorio, f'v{VERSAO_FORMATO_MODELOS}')
+        self._caminho_manifesto = os.path.join(self.diretorio, 'manifesto.json')
+        self._caminho_trava = os.path.join(self.diretorio, 'manifesto.lock')
+        self._lock = threading.Lock()
+        self._com_trava_arquivo = False # Se a trava de arquivo já está com a thread que tem self._lock
+        self._manifesto = None # Lido do disco no primeiro acesso
+        self.carregados = 0
+        self.salvos = 0
+        self.descartados = 0
+
+    def _arquivo(self, item_id):
+        return os.path.join(self.diretorio, f'item_{item_id}.joblib')
+
+    @contextmanager
+    def _trava_arquivo(self):
+        """
+        Trava de arquivo entre processos; chamar com self._lock adquirido. Se a trava já
+        está adquirida (dentro de `_travado`), não trava de novo: o flock de um segundo
+        descritor do mesmo arquivo esperaria pelo primeiro.
+        """
+        if self._com_trava_arquivo:
+            yield
+            return
+        os.makedirs(self.diretorio, exist_ok=True)
+        with open(self._caminho_trava, 'a+b') as trava:
+            if fcntl is not None:
+                fcntl.flock(trava.fileno(), fcntl.LOCK_EX)
+            else:
+                trava.seek(0)
+                msvcrt.locking(trava.fileno(), msvcrt.LK_LOCK, 1)
+            self._com_trava_arquivo = True
+            try:
+                yield
+            finally:
+                self._com_trava_arquivo = False
+                if fcntl is not None:
+                    fcntl.flock(trava.fileno(), fcntl.LOCK_UN)
+                else:
+                    trava.seek(0)
+                    msvcrt.locking(trava.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @contextmanager
+    def _travado(self):
+        """Exclusão mútua entre as threads deste processo e entre processos (trava de arquivo)."""
+        with self._lock, self._trava_arquivo():
+            yield
+
+    def _substituir_arquivo(self, destino, gravar):
+        """Grava em um temporário único (`gravar(caminho)`) e o move atomicamente para `destino`."""
+        descritor, temporario = tempfile.mkstemp(dir=self.diretorio, suffix='.tmp')
+        os.close(descritor)
+        try:
+            gravar(temporario)
+            os.replace(temporario, destino)
+        except BaseException:
+            try:
+                os.remove(temporario)
+            except OSError:
+                pass
+            raise
+
+    def _ler_arquivo_manifesto(self):
+        try:
+            with open(self._caminho_manifesto, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Alerta: Manifesto de modelos ilegível ({e}). Modelos em disco serão ignorados.")
+            return None
+
+    def _ler_manifesto(self):
+        """Manifesto em memória (lido do disco no primeiro acesso); chamar com self._lock adquirido."""
+        if self._manifesto is not None:
+            return self._manifesto
+        manifesto = self._ler_arquivo_manifesto()
+        if manifesto is not None and manifesto.get('bibliotecas') != _versoes_bibliotecas():
+            # Descarte sob a trava de arquivo: outro processo pode estar gravando (ou já ter
+            # descartado e regravado) o manifesto, então ele é relido antes
+            with self._trava_arquivo():
+                manifesto = self._ler_arquivo_manifesto()
+                if manifesto is not None and manifesto.get('bibliotecas') != _versoes_bibliotecas():
+                    print("Alerta: Modelos em disco foram treinados com outras versões das bibliotecas. Descartando.")
+                    for item_id in list(manifesto.get('modelos', {})):
+                        self._remover_arquivo(item_id)
+                        self.descartados += 1
+                    self._manifesto = {'formato': VERSAO_FORMATO_MODELOS, 'bibliotecas': _versoes_bibliotecas(), 'modelos': {}}
+                    try:
+                        self._gravar_manifesto()
+                    except OSError as e:
+                        print(f"Alerta: Falha ao regravar o manifesto de modelos: {e}")
+                    return self._manifesto
+        self._manifesto = manifesto or {'formato': VERSAO_FORMATO_MODELOS, 'bibliotecas': _versoes_bibliotecas(), 'modelos': {}}
+        return self._manifesto
+
+    def _gravar_manifesto(self):
+        def gravar(caminho):
+            with open(caminho, 'w', encoding='utf-8') as f:
+                json.dump(self._manifesto, f, indent=1)
+        self._substituir_arquivo(self._caminho_manifesto, gravar)
+
+    def _remover_arquivo(self, item_id):
+        try:
+            os.remove(self._arquivo(item_id))
+        except FileNotFoundError:
+            pass
+
+    def _recarregar_manifesto(self):
+        self._manifesto = None
+        return self._ler_manifesto()
+
+    def carregar(self, item_id, chave):
+        """Carrega o modelo do item se o gravado tiver exatamente a mesma chave; senão None."""
+        with self._lock:
+            entrada = self._ler_manifesto()['modelos'].get(str(item_id))
+            if entrada is None or entrada['chave'] != list(chave):
+                # Outro processo pode ter gravado o modelo depois da nossa leitura
+                entrada = self._recarregar_manifesto()['modelos'].get(str(item_id))
+            if entrada is None or entrada['chave'] != list(chave):
+                return None
+            try:
+                modelo = joblib.load(self._arquivo(item_id), mmap_mode='r')
+            except Exception as e:
+                print(f"Alerta: Falha ao carregar modelo do item {item_id} do disco ({e}). Descartando.")
+                modelo = None
+            else:
+                self.carregados += 1
+                return modelo
+        self._descartar(item_id, list(chave))
+        return None
+
+    def _descartar(self, item_id, chave):
+        """Remove o modelo ilegível do item (se ninguém o substituiu nesse meio tempo)."""
+        try:
+            with self._travado():
+                entrada = self._recarregar_manifesto()['modelos'].get(str(item_id))
+                if entrada is not None and entrada['chave'] == chave:
+                    del self._manifesto['modelos'][str(item_id)]
+                    self._remover_arquivo(item_id)
+                    self._gravar_manifesto()
+                    self.descartados += 1
+        except OSError as e:
+            print(f"Alerta: Falha ao descartar modelo do item {item_id}: {e}")
+
+    def salvar(self, item_id, chave, modelo, versao_historico):
+        """Grava (substituindo) o modelo do item e atualiza o manifesto."""
+        try:
+            with self._travado():
+                manifesto = self._recarregar_manifesto()
+                self._substituir_arquivo(self._arquivo(item_id), lambda caminho: joblib.dump(modelo, caminho))
+                manifesto['modelos'][str(item_id)] = {
+                    'chave': list(chave),
+                    'versao_historico': versao_historico,
+                    'salvo_em': datetime.now().isoformat(timespec='seconds'),
+                }
+                self._gravar_manifesto()
+                self.salvos += 1
+        except OSError as e:
+            print(f"Alerta: Falha ao gravar modelo do item {item_id} em disco: {e}")
+
+    def podar(self, versoes_atuais):
+        """
+        Remove os modelos cujo histórico de treino não corresponde mais ao banco e os
+        arquivos de modelo que não constam no manifesto (e.g., de gravações interrompidas).
+
+        Args:
+            versoes_atuais (dict): item_id -> versão atual do histórico. Itens ausentes
+                                   (e.g., excluídos) também têm o modelo removido.
+
+        Returns:
+            int: Número de modelos removidos.
+        """
+        with self._travado():
+            modelos = self._recarregar_manifesto()['modelos']
+            obsoletos = [item_id for item_id, entrada in modelos.items()
+                         if versoes_atuais.get(int(item_id)) != entrada['versao_historico']]
+            for item_id in obsoletos:
+                del modelos[item_id]
+                self._remover_arquivo(item_id)
+            if obsoletos:
+                self._gravar_manifesto()
+            orfaos = [nome for nome in os.listdir(self.diretorio)
+                      if (nome.startswith('item_') and nome.endswith('.joblib') and nome[5:-7] not in modelos)
+                      or nome.endswith('.tmp')]
+            for nome in orfaos:
+                try:
+                    os.remove(os.path.join(self.diretorio, nome))
+                except FileNotFoundError:
+                    pass
+            removidos = len(obsoletos) + sum(nome.endswith('.joblib') for nome in orfaos)
+            self.descartados += removidos
+            return removidos
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'diretorio': self.diretorio,
+                'modelos_gravados': len(self._manifesto['modelos']) if self._manifesto else None,
+                'carregados': self.carregados,
+                'salvos': self.salvos,
+                'descartados': self.descartados,
+            }
+
+repositorio_modelos = RepositorioModelos()
+
+def inicializar_processo_previsao(governador=None):
+    """
+    Inicializador dos processos do pool de previsões (app.py). Passa a usar o governador
+    de paralelismo compartilhado com os demais processos (`governador`, criado por
+    `criar_governador_compartilhado` no processo principal). pandas/sklearn já são
+    importados junto com este módulo; um treino mínimo carrega também os submódulos
+    que o sklearn só importa no primeiro fit/predict, para a primeira previsão real
+    de cada processo não pagar esse custo.
+    """
+    global governador_paralelismo
+    if governador is not None:
+        governador_paralelismo = governador
+    modelo = RandomForestRegressor(n_estimators=1, n_jobs=1).fit(np.zeros((2, 1)), np.zeros(2))
+    modelo.predict(np.zeros((1, 1)))
+
+def _contadores_processo():
+    cache = cache_modelos.estatisticas()
+    repositorio = repositorio_modelos.estatisticas()
+    return {
+        'cache_modelos': {nome: cache[nome] for nome in ('acertos', 'falhas', 'remocoes')},
+        'repositorio_modelos': {nome: repositorio[nome] for nome in ('carregados', 'salvos', 'descartados')},
+        'tamanho_cache': cache['tamanho'],
+    }
+
+def executar_com_metricas(funcao, *args, **kwargs):
+    """
+    Executa `funcao` (num processo do pool de previsões) e retorna (resultado, métricas).
+    As métricas trazem quanto os contadores do cache e do repositório deste processo
+    mudaram durante a chamada, o tamanho atual do cache e o pid, para o processo
+    principal somar os números de todos os processos (app.py, /api/metricas).
+    """
+    antes = _contadores_processo()
+    resultado = funcao(*args, **kwargs)
+    depois = _contadores_processo()
+    metricas = {grupo: {nome: depois[grupo][nome] - antes[grupo][nome] for nome in depois[grupo]}
+                for grupo in ('cache_modelos', 'repositorio_modelos')}
+    metricas.update(pid=os.getpid(), tamanho_cache=depois['tamanho_cache'])
+    return resultado, metricas
+
+# --- Governador de Paralelismo (orçamento de núcleos para os fits) ---
+# Total de núcleos que os treinos podem usar ao mesmo tempo (neste processo ou, com o
+# governador compartilhado, somando todos os processos do pool de previsões).
+ORCAMENTO_NUCLEOS = os.cpu_count() or 1
+
+# Tempo máximo (s) que um treino espera por núcleo livre; depois disso treina com 1 núcleo
+# mesmo acima do orçamento (um processo travado não deve parar os demais)
+ESPERA_MAXIMA_NUCLEOS = 10.0
+
+# Posições do estado do governador (lista local ou array em memória compartilhada)
+(_LIVRES, _ATIVOS, _AGUARDANDO, _CONCESSOES, _ESPERAS, _ESPERAS_ESGOTADAS,
+ _ESPERA_TOTAL, _ESPERA_MAXIMA) = range(8)
+
+class GovernadorParalelismo:
+    """
+    Distribui núcleos (tokens) entre os treinos concorrentes, para que vários `fit`
+    simultâneos não criem, cada um, threads para todos os núcleos.
+
+    Cada treino recebe uma fatia do orçamento dividida pelo número de treinos esperados:
+    o maior entre `treinos_esperados` (e.g., o número de processos do pool, que podem
+    treinar ao mesmo tempo) e os treinos em andamento ou esperando, incluindo ele. Assim
+    o primeiro treino não leva todos os núcleos quando outros estão para chegar. A fatia
+    é limitada aos núcleos livres, com no mínimo 1. Sem núcleo livre, o treino espera
+    até `espera_maxima` segundos e então treina com 1 núcleo; as esperas são contadas.
+
+    Com `contexto` (um contexto do multiprocessing), o estado e a condição ficam em
+    memória compartilhada: o mesmo governador, passado aos processos do pool pelo
+    inicializador, divide o orçamento entre todos eles e os contadores somam os
+    treinos de todos os processos.
+    """
+    def __init__(self, total=ORCAMENTO_NUCLEOS, contexto=None, treinos_esperados=1, espera_maxima=ESPERA_MAXIMA_NUCLEOS):
+        self.total = max(1, total)
+        self.treinos_esperados = max(1, treinos_esperados)
+        self.espera_maxima = espera_maxima
+        estado_inicial = [float(self.total)] + [0.0] * 7
+        if contexto is None:
+            self._cond = threading.Condition()
+            self._estado = estado_inicial
+        else:
+            self._cond = contexto.Condition()
+            self._estado = contexto.RawArray('d', estado_inicial)
+        self.compartilhado = contexto is not None
+
+    @contextmanager
+    def nucleos(self, maximo=-1):
+        """
+        Reserva núcleos durante o bloco `with` e devolve quantos foram concedidos.
+
+        Args:
+            maximo (int): Máximo desejado (-1 ou None = sem limite além do orçamento).
+        """
+        maximo = self.total if maximo is None or maximo < 1 else min(maximo, self.total)
+        estado = self._estado
+        with self._cond:
+            inicio_espera = None
+            while estado[_LIVRES] < 1:
+                if inicio_espera is None:
+                    inicio_espera = time.perf_counter()
+                    estado[_AGUARDANDO] += 1
+                restante = self.espera_maxima - (time.perf_counter() - inicio_espera)
+                if restante <= 0:
+                    estado[_ESPERAS_ESGOTADAS] += 1
+                    break
+                self._cond.wait(restante)
+            if inicio_espera is not None:
+                estado[_AGUARDANDO] -= 1
+                espera = time.perf_counter() - inicio_espera
+                estado[_ESPERAS] += 1
+                estado[_ESPERA_TOTAL] += espera
+                estado[_ESPERA_MAXIMA] = max(estado[_ESPERA_MAXIMA], espera)
+            treinos = max(self.treinos_esperados, int(estado[_ATIVOS]) + int(estado[_AGUARDANDO]) + 1)
+            concedidos = max(1, min(maximo, int(estado[_LIVRES]), self.total // treinos))
+            estado[_LIVRES] -= concedidos
+            estado[_ATIVOS] += 1
+            estado[_CONCESSOES] += 1
+        try:
+            yield concedidos
+        finally:
+            with self._cond:
+                estado[_LIVRES] += concedidos
+                estado[_ATIVOS] -= 1
+                self._cond.notify_all()
+
+    def estatisticas(self):
+        with self._cond:
+            estado = list(self._estado)
+        return {
+            'orcamento_nucleos': self.total,
+            'treinos_esperados': self.treinos_esperados,
+            'compartilhado_entre_processos': self.compartilhado,
+            'nucleos_livres': int(estado[_LIVRES]),
+            'treinos_ativos': int(estado[_ATIVOS]),
+            'treinos_aguardando': int(estado[_AGUARDANDO]),
+            'concessoes': int(estado[_CONCESSOES]),
+            'esperas': int(estado[_ESPERAS]),
+            'esperas_esgotadas': int(estado[_ESPERAS_ESGOTADAS]),
+            'tempo_espera_total_s': round(estado[_ESPERA_TOTAL], 4),
+            'tempo_espera_maximo_s': round(estado[_ESPERA_MAXIMA], 4),
+        }
+
+governador_paralelismo = GovernadorParalelismo()
+
+def criar_governador_compartilhado(contexto, treinos_esperados=1, total=ORCAMENTO_NUCLEOS):
+    """
+    Substitui o governador deste processo por um em memória compartilhada (ver
+    GovernadorParalelismo), para ser repassado a `inicializar_processo_previsao`.
+    `treinos_esperados`: quantos treinos podem rodar ao mesmo tempo (processos do pool).
+    """
+    global governador_paralelismo
+    governador_paralelismo = GovernadorParalelismo(total, contexto=contexto, treinos_esperados=treinos_esperados)
+    return governador_paralelismo
+
+def treinar_modelo(modelo, X, y, n_jobs=-1, pesos=None):
+    """
+    Treina o modelo com os núcleos concedidos pelo governador (limitados a `n_jobs`).
+    `pesos` é repassado ao fit como sample_weight (ver `aplicar_janela_treino`).
+    Depois do treino o modelo fica com n_jobs=1 (quando tiver esse parâmetro): as previsões são de poucas linhas e
+    não compensam abrir threads (nem consomem o orçamento).
+    """
+    usa_n_jobs = 'n_jobs' in modelo.get_params()
+    with governador_paralelismo.nucleos(n_jobs) as nucleos:
+        if usa_n_jobs:
+            modelo.set_params(n_jobs=nucleos)
+            modelo.fit(X, y, sample_weight=pesos)
+        else: # e.g. HistGradientBoosting: paraleliza com threads OpenMP
+            with threadpool_limits(limits=nucleos, user_api='openmp'):
+                modelo.fit(X, y, sample_weight=pesos)
+    if usa_n_jobs:
+        modelo.set_params(n_jobs=1)
+    return modelo
+
+# --- Floresta em Arrays Planos (inferência sem sklearn) ---
+# O predict do sklearn valida a entrada e despacha as árvores pelo joblib a cada chamada,
+# o que domina o custo quando se prevê uma linha por vez (previsão recursiva). A floresta
+# treinada é exportada para arrays NumPy e percorrida de forma vetorizada.
+USAR_FLORESTA_PLANA = True
+
+class FlorestaPlana:
+    """
+    Nós de todas as árvores de uma RandomForestRegressor concatenados em arrays planos
+    (feature, limiar, filho esquerdo/direito e valor), com índices globais.
+
+    As folhas apontam para si mesmas, então a travessia avança todas as árvores e todas
+    as linhas juntas por `profundidade` passos, sem máscaras. Segue as regras do sklearn:
+    entrada convertida para float32 e desvio para a esquerda quando x <= limiar.
+    Só depende do NumPy (também quando carregada do disco).
+    """
+    def __init__(self, feature, limiar, esquerda, direita, valor, raizes, profundidade, n_features_in_, nome_modelo):
+        self.feature = feature
+        self.limiar = limiar
+        self.esquerda = esquerda
+        self.direita = direita
+        self.valor = valor # (nós, saídas)
+        self.raizes = raizes
+        self.profundidade = profundidade
+        self.n_features_in_ = n_features_in_
+        self.nome_modelo = nome_modelo
+
+    @classmethod
+    def de_floresta(cls, modelo):
+        """Exporta uma floresta treinada (RandomForestRegressor) para arrays planos."""
+        arvores = [estimador.tree_ for estimador in modelo.estimators_]
+        tamanhos = np.array([arvore.node_count for arvore in arvores])
+        deslocamentos = np.concatenate(([0], np.cumsum(tamanhos)[:-1]))
+        feature, limiar, esquerda, direita, valor = [], [], [], [], []
+        for arvore, deslocamento in zip(arvores, deslocamentos):
+            nos = np.arange(arvore.node_count)
+            folha = arvore.children_left == -1
+            feature.append(np.where(folha, 0, arvore.feature))
+            limiar.append(arvore.threshold)
+            esquerda.append(np.where(folha, nos, arvore.children_left) + deslocamento)
+            direita.append(np.where(folha, nos, arvore.children_right) + deslocamento)
+            valor.append(arvore.value[:, :, 0])
+        return cls(np.concatenate(feature).astype(np.intp), np.concatenate(limiar).astype(np.float64),
+                   np.concatenate(esquerda).astype(np.intp), np.concatenate(direita).astype(np.intp),
+                   np.concatenate(valor).astype(np.float64), deslocamentos.astype(np.intp),
+                   max(arvore.max_depth for arvore in arvores), modelo.n_features_in_, type(modelo).__name__)
+
+    def prever_por_arvore(self, X):
+        """Previsão de cada árvore para cada linha: array (árvores, linhas, saídas)."""
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X tem {X.shape[1]} features, mas a floresta espera {self.n_features_in_}.")
+        nos = np.repeat(self.raizes[:, None], len(X), axis=1)
+        linhas = np.arange(len(X))
+        for _ in range(self.profundidade):
+            nos = np.where(X[linhas, self.feature[nos]] <= self.limiar[nos], self.esquerda[nos], self.direita[nos])
+        return self.valor[nos]
+
+    def predict(self, X):
+        """Média das árvores, no mesmo formato do `predict` do sklearn (interface usada pelos buffers)."""
+        media = self.prever_por_arvore(X).mean(axis=0)
+        return media[:, 0] if media.shape[1] == 1 else media
+
+def para_floresta_plana(modelo):
+    """Converte uma RandomForestRegressor treinada em FlorestaPlana (se USAR_FLORESTA_PLANA); outros modelos passam direto."""
+    if USAR_FLORESTA_PLANA and isinstance(modelo, RandomForestRegressor):
+        return FlorestaPlana.de_floresta(modelo)
+    return modelo
+
+def nome_modelo(modelo):
+    return getattr(modelo, 'nome_modelo', type(modelo).__name__)
+
+# --- Camada Rápida: Previsores para Demanda Intermitente ---
+# Para históricos curtos ou com muitos dias sem consumo, o RandomForest custa muita CPU
+# e acrescenta pouca precisão; nesses casos usamos previsores de forma fechada (O(n)).
+USAR_CAMADA_RAPIDA = True
+MIN_DIAS_FLORESTA = 28 # Abaixo disso (dias de histórico) não vale treinar a floresta
+LIMIAR_INTERMITENCIA = 0.7 # Fração de dias sem consumo a partir da qual a demanda é intermitente
+METODO_INTERMITENTE = 'sba' # 'croston', 'sba' ou 'tsb'
+ALFA_INTERMITENTE = 0.1
+ALFA_SES = 0.3
+
+def nivel_suavizado(valores, alfa):
+    """
+    Nível final da suavização exponencial simples (inicializada com o primeiro valor).
+
+    Em vez da recursão nivel = alfa * y + (1 - alfa) * nivel, usa a forma fechada:
+    uma média ponderada com pesos alfa * (1 - alfa)^k, calculada em uma única passada.
+    """
+    valores = np.asarray(valores, dtype=float)
+    n = len(valores)
+    if n == 0:
+        return 0.0
+    pesos = alfa * (1 - alfa) ** np.arange(n - 1, -1, -1, dtype=float)
+    pesos[0] = (1 - alfa) ** (n - 1) # Peso do valor inicial
+    return float(np.dot(pesos, valores))
+
+def taxa_ses(valores, alfa=ALFA_SES):
+    """Consumo diário previsto pela suavização exponencial simples."""
+    return nivel_suavizado(valores, alfa)
+
+def taxa_croston(valores, alfa=ALFA_INTERMITENTE, sba=False):
+    """
+    Consumo diário previsto pelo método de Croston: suaviza separadamente o tamanho
+    das demandas e o intervalo (em dias) entre elas. Com `sba=True`, aplica a correção
+    de viés de Syntetos-Boylan (fator 1 - alfa/2).
+    """
+    valores = np.asarray(valores, dtype=float)
+    indices = np.flatnonzero(valores)
+    if len(indices) == 0:
+        return 0.0
+    intervalos = np.diff(indices, prepend=-1) # O primeiro intervalo conta desde o início da série
+    taxa = nivel_suavizado(valores[indices], alfa) / nivel_suavizado(intervalos, alfa)
+    return taxa * (1 - alfa / 2) if sba else taxa
+
+def taxa_tsb(valores, alfa_demanda=ALFA_INTERMITENTE, alfa_probabilidade=ALFA_INTERMITENTE):
+    """
+    Consumo diário previsto pelo método TSB (Teunter-Syntetos-Babai): a probabilidade
+    de haver consumo é atualizada todo dia e o tamanho só nos dias com consumo.
+    """
+    valores = np.asarray(valores, dtype=float)
+    indices = np.flatnonzero(valores)
+    if len(indices) == 0:
+        return 0.0
+    probabilidade = nivel_suavizado(valores > 0, alfa_probabilidade)
+    return probabilidade * nivel_suavizado(valores[indices], alfa_demanda)
+
+METODOS_CAMADA_RAPIDA = {
+    'croston': ('Croston', lambda v: taxa_croston(v)),
+    'sba': ('Croston (SBA)', lambda v: taxa_croston(v, sba=True)),
+    'tsb': ('TSB', lambda v: taxa_tsb(v)),
+    'ses': ('Suavização Exponencial Simples', lambda v: taxa_ses(v)),
+}
+
+def escolher_camada_rapida(valores):
+    """
+    Decide se a série deve ser prevista pela camada rápida e com qual método.
+
+    Returns:
+        tuple: (chave do método em METODOS_CAMADA_RAPIDA, motivo) ou (None, None) se
+               a série justifica treinar a floresta.
+    """
+    n = len(valores)
+    fracao_sem_consumo = 1 - np.count_nonzero(valores) / n if n else 1.0
+    intermitente = fracao_sem_consumo >= LIMIAR_INTERMITENCIA
+    if n >= MIN_DIAS_FLORESTA and not intermitente:
+        return None, None
+    motivo = (f'demanda intermitente ({fracao_sem_consumo:.0%} dos dias sem consumo)' if intermitente
+              else f'histórico curto ({n} dia{"s" if n != 1 else ""})')
+    # Croston/TSB precisam de ao menos duas demandas para estimar o intervalo entre elas
+    if intermitente and np.count_nonzero(valores) >= 2:
+        return METODO_INTERMITENTE, motivo
+    return 'ses', motivo
+
+def prever_camada_rapida(valores, dias_para_prever, metodo):
+    """Retorna (previsão total para o horizonte, nome do método)."""
+    nome, funcao_taxa = METODOS_CAMADA_RAPIDA[metodo]
+    return max(0.0, funcao_taxa(valores)) * dias_para_prever, nome
+
+# --- Intervalos de Previsão (p10/p50/p90 do total do horizonte) ---
+# Floresta: quantis dos totais previstos por cada árvore já treinada (sem novo treino).
+# Demais métodos: bootstrap dos resíduos diários recentes, somados ao total previsto.
+QUANTIS_INTERVALO = {'previsao_p10': 10, 'previsao_p50': 50, 'previsao_p90': 90}
+AMOSTRAS_BOOTSTRAP = 500
+JANELA_RESIDUOS = 90 # Dias mais recentes usados como resíduos no bootstrap
+
+def _campos_intervalo(totais, metodo):
+    quantis = np.percentile(np.maximum(totais, 0), list(QUANTIS_INTERVALO.values()))
+    campos = {nome: round(float(q), 2) for nome, q in zip(QUANTIS_INTERVALO, quantis)}
+    campos['metodo_intervalo'] = metodo
+    return campos
+
+def intervalo_floresta(modelo, linhas):
+    """
+    Intervalo a partir das previsões de cada árvore da floresta (uma única travessia na
+    FlorestaPlana; uma passada por `estimators_` na floresta do sklearn).
+
+    Args:
+        modelo: FlorestaPlana ou RandomForestRegressor treinado.
+        linhas (np.ndarray): Linhas de features usadas na previsão pontual: uma por dia na
+                             estratégia recursiva (trajetória da média das árvores) ou uma
+                             única linha na direta (cada árvore prevê todo o horizonte).
+
+    Returns:
+        dict: 'previsao_p10', 'previsao_p50', 'previsao_p90' e 'metodo_intervalo'.
+    """
+    linhas = np.ascontiguousarray(np.atleast_2d(linhas), dtype=np.float32)
+    if isinstance(modelo, FlorestaPlana):
+        por_arvore = modelo.prever_por_arvore(linhas)
+    else:
+        por_arvore = np.stack([arvore.predict(linhas, check_input=False) for arvore in modelo.estimators_])
+    totais = np.maximum(por_arvore, 0).reshape(len(por_arvore), -1).sum(axis=1)
+    return _campos_intervalo(totais, 'árvores da floresta')
+
+def intervalo_bootstrap(previsao_total, residuos, dias_para_prever, semente=42):
+    """
+    Intervalo por bootstrap: soma `dias_para_prever` resíduos diários sorteados (com reposição,
+    entre os últimos JANELA_RESIDUOS) ao total previsto, AMOSTRAS_BOOTSTRAP vezes.
+    """
+    residuos = np.asarray(residuos, dtype=float)[-JANELA_RESIDUOS:]
+    if len(residuos) == 0:
+        return _campos_intervalo(np.array([previsao_total]), 'bootstrap de resíduos')
+    rng = np.random.default_rng(semente)
+    amostras = previsao_total + rng.choice(residuos, size=(AMOSTRAS_BOOTSTRAP, dias_para_prever)).sum(axis=1)
+    return _campos_intervalo(amostras, 'bootstrap de resíduos')
+
+def intervalo_taxa(valores, previsao_total, dias_para_prever, semente=42):
+    """
+    Bootstrap para métodos de taxa diária constante (média, SES, Croston...): sorteia
+    `dias_para_prever` demandas diárias entre os dias recentes (com reposição) e escala as
+    somas para a média delas ser o total previsto pelo método. Assim o intervalo mantém a
+    forma da demanda real (muitos zeros na intermitente) sem ficar abaixo da previsão.
+    A faixa p10-p90 sempre contém a previsão (com demanda muito intermitente quase todas
+    as somas sorteadas são zero e o p90 ficaria abaixo da média).
+    """
+    metodo = 'bootstrap da demanda diária'
+    recentes = np.asarray(valores, dtype=float)[-JANELA_RESIDUOS:]
+    media_recente = recentes.mean() if len(recentes) else 0.0
+    if media_recente <= 0 or previsao_total <= 0:
+        return _campos_intervalo(np.array([previsao_total]), metodo)
+    rng = np.random.default_rng(semente)
+    somas = rng.choice(recentes, size=(AMOSTRAS_BOOTSTRAP, dias_para_prever)).sum(axis=1)
+    campos = _campos_intervalo(somas * (previsao_total / (media_recente * dias_para_prever)), metodo)
+    previsao = round(float(previsao_total), 2)
+    campos['previsao_p10'] = min(campos['previsao_p10'], previsao)
+    campos['previsao_p90'] = max(campos['previsao_p90'], previsao)
+    return campos
+
+# --- Previsão Incremental (SES atualizada a cada consumo) ---
+# O estado de cada item resume todo o histórico: o nível da SES até o dia anterior ao do
+# último consumo, o total (parcial) desse dia e as médias exponenciais de y e y² (para o
+# intervalo). Um consumo novo atualiza o estado em O(1): dias sem consumo no meio do caminho
+# entram pela forma fechada (1 - alfa)^dias, sem percorrer a série. A previsão é a mesma da
+# SES da camada rápida sobre a série completa.
+ALFA_MOMENTOS_INCREMENTAL = 2 / (JANELA_RESIDUOS + 1) # Janela efetiva equivalente à dos resíduos
+Z_QUANTIL_90 = 1.2815515655446004 # Quantil 0,9 da normal padrão (p10/p90 = centro ∓ z·σ)
+
+def estado_incremental_de_valores(valores, dia_inicial, alfa=ALFA_SES, alfa_momentos=ALFA_MOMENTOS_INCREMENTAL):
+    """
+    Monta o estado incremental a partir da série diária contínua (usado na primeira vez e
+    quando o estado gravado não corresponde mais ao histórico).
+
+    Returns:
+        dict: 'dia_corrente', 'acumulado', 'nivel', 'momento1' e 'momento2' ('nivel' e os
+              momentos cobrem os dias antes de 'dia_corrente'; None se ele é o primeiro dia).
+    """
+    valores = np.asarray(valores, dtype=float)
+    anteriores = valores[:-1]
+    vazio = len(anteriores) == 0
+    return {
+        'dia_corrente': int(dia_inicial) + len(valores) - 1,
+        'acumulado': float(valores[-1]),
+        'nivel': None if vazio else nivel_suavizado(anteriores, alfa),
+        'momento1': None if vazio else nivel_suavizado(anteriores, alfa_momentos),
+        'momento2': None if vazio else nivel_suavizado(anteriores ** 2, alfa_momentos),
+    }
+
+def _fechar_estado(estado, alfa, alfa_momentos):
+    """Nível e momentos incluindo o dia corrente (o estado em si não muda)."""
+    y = estado['acumulado']
+    if estado['nivel'] is None: # Primeiro dia da série: a SES começa no primeiro valor
+        return y, y, y * y
+    return (alfa * y + (1 - alfa) * estado['nivel'],
+            alfa_momentos * y + (1 - alfa_momentos) * estado['momento1'],
+            alfa_momentos * y * y + (1 - alfa_momentos) * estado['momento2'])
+
+def atualizar_estado_incremental(estado, dia, quantidade, alfa=ALFA_SES, alfa_momentos=ALFA_MOMENTOS_INCREMENTAL):
+    """
+    Aplica um consumo de `quantidade` no dia `dia` ao estado, em O(1).
+
+    Returns:
+        dict: Novo estado, ou None se o consumo é de um dia anterior ao corrente
+              (nesse caso o estado precisa ser remontado a partir do histórico).
+    """
+    if dia < estado['dia_corrente']:
+        return None
+    if dia == estado['dia_corrente']:
+        return dict(estado, acumulado=estado['acumulado'] + quantidade)
+    nivel, momento1, momento2 = _fechar_estado(estado, alfa, alfa_momentos)
+    dias_sem_consumo = dia - estado['dia_corrente'] - 1
+    decaimento = (1 - alfa) ** dias_sem_consumo
+    decaimento_momentos = (1 - alfa_momentos) ** dias_sem_consumo
+    return {'dia_corrente': int(dia), 'acumulado': float(quantidade), 'nivel': nivel * decaimento,
+            'momento1': momento1 * decaimento_momentos, 'momento2': momento2 * decaimento_momentos}
+
+def prever_estado_incremental(estado, dias_para_prever, alfa=ALFA_SES, alfa_momentos=ALFA_MOMENTOS_INCREMENTAL):
+    """
+    Previsão (e intervalo p10/p50/p90 por aproximação normal) lida do estado incremental,
+    sem consultar o histórico.
+    """
+    nivel, momento1, momento2 = _fechar_estado(estado, alfa, alfa_momentos)
+    previsao_total = max(0.0, nivel) * dias_para_prever
+    desvio_total = float(np.sqrt(max(momento2 - momento1 ** 2, 0.0) * dias_para_prever))
+    nome_metodo = f"{METODOS_CAMADA_RAPIDA['ses'][0]} (incremental)"
+    return {'previsao': round(previsao_total, 2), 'message': f'Previsão gerada com {nome_metodo}, atualizada a cada consumo.',
+            'metodo': nome_metodo,
+            'previsao_p10': round(max(0.0, previsao_total - Z_QUANTIL_90 * desvio_total), 2),
+            'previsao_p50': round(previsao_total, 2),
+            'previsao_p90': round(previsao_total + Z_QUANTIL_90 * desvio_total, 2),
+            'metodo_intervalo': 'aproximação normal (variância exponencial)'}
+
+# --- Estratégia de Previsão ---
+# 'recursiva': prevê um dia por vez, realimentando cada previsão como lag do dia seguinte.
+# 'direta': um modelo multi-saída prevê todos os dias do horizonte em um único predict.
+ESTRATEGIA_PREVISAO = 'recursiva'
+ESTRATEGIAS_PREVISAO = ('recursiva', 'direta')
 
 def criar_features_temporais(df, lag_max=7, janela_movel=7):
     """
@@ -49,140 +833,767 @@ def criar_features_temporais(df, lag_max=7, janela_movel=7):
 
     return df
 
-def obter_previsao_sklearn(df_historico_consumo, dias_para_prever=7):
+def _semanas_iso_no_ano(anos):
+    """Número de semanas ISO (52 ou 53) de cada ano do array."""
+    def p(a):
+        return (a + a // 4 - a // 100 + a // 400) % 7
+    return 52 + ((p(anos) == 4) | (p(anos - 1) == 3))
+
+def calendario_por_numero_dia(dias):
     """
-    Obtém a previsão de consumo usando scikit-learn, recebendo os dados históricos.
+    Calcula as features de calendário a partir de números de dia (dias desde 1970-01-01).
+
+    Returns:
+        np.ndarray: Matriz (n, 6) int64 com dia_da_semana, semana_do_ano (ISO), mes,
+                    dia_do_mes, dia_do_ano e ano, na ordem de `criar_features_temporais`.
+    """
+    dias = np.asarray(dias, dtype=np.int64)
+    datas = dias.astype('datetime64[D]')
+    inicio_ano = datas.astype('datetime64[Y]')
+    inicio_mes = datas.astype('datetime64[M]')
+
+    ano = inicio_ano.astype(np.int64) + 1970
+    mes = (inicio_mes - inicio_ano.astype('datetime64[M]')).astype(np.int64) + 1
+    dia_do_mes = (datas - inicio_mes.astype('datetime64[D]')).astype(np.int64) + 1
+    dia_do_ano = (datas - inicio_ano.astype('datetime64[D]')).astype(np.int64) + 1
+    dia_da_semana = (dias + 3) % 7 # 1970-01-01 foi uma quinta-feira (segunda = 0)
+
+    # Semana ISO: pode pertencer ao ano anterior (semana 0 -> última do ano anterior)
+    # ou ao seguinte (semana 53 em ano de 52 semanas -> semana 1)
+    semana = (dia_do_ano - (dia_da_semana + 1) + 10) // 7
+    semana = np.where(semana < 1, _semanas_iso_no_ano(ano - 1),
+                      np.where(semana > _semanas_iso_no_ano(ano), 1, semana))
+
+    return np.column_stack([dia_da_semana, semana, mes, dia_do_mes, dia_do_ano, ano])
+
+def criar_features_temporais_np(valores, dia_inicial, lag_max=7, janela_movel=7):
+    """
+    Versão vetorizada (NumPy) de `criar_features_temporais`, que continua sendo a
+    implementação de referência.
+
+    Os lags são lidos de uma visão deslizante (sem cópia) da série, a média/desvio
+    padrão móveis vêm de somas acumuladas e o calendário é calculado a partir de
+    números de dia inteiros.
 
     Args:
-        df_historico_consumo (pd.DataFrame): DataFrame com colunas 'data_consumo' e 'quantidade'.
+        valores (array-like): Série diária contínua (já com fillna(0)).
+        dia_inicial (int): Número do dia (dias desde 1970-01-01) do primeiro valor.
+        lag_max (int): Número máximo de lags a serem criados.
+        janela_movel (int): Tamanho da janela para calcular médias/std móveis.
+
+    Returns:
+        tuple: (matriz float32, lista de nomes das colunas). As colunas e as linhas
+               (após descartar as iniciais incompletas) são as mesmas de
+               `criar_features_temporais`, com 'quantidade' na primeira coluna.
+    """
+    colunas = (['quantidade', 'dia_da_semana', 'semana_do_ano', 'mes', 'dia_do_mes', 'dia_do_ano', 'ano']
+               + [f'lag_{lag}' for lag in range(1, lag_max + 1)]
+               + [f'media_movel_{janela_movel}d', f'std_movel_{janela_movel}d'])
+    valores = np.asarray(valores, dtype=np.float64)
+    n = len(valores)
+
+    # Linhas descartadas: lags incompletos e std indefinido (menos de 2 valores na janela)
+    inicio = max(lag_max, 2)
+    if n <= inicio or janela_movel < 2:
+        return np.empty((0, len(colunas)), dtype=np.float32), colunas
+
+    linhas = np.arange(inicio, n)
+    matriz = np.empty((len(linhas), len(colunas)), dtype=np.float32)
+    matriz[:, 0] = valores[inicio:]
+    matriz[:, 1:7] = calendario_por_numero_dia(dia_inicial + linhas)
+
+    # Lags: janela deslizante de tamanho lag_max; a coluna j da visão (invertida) é o lag j+1
+    if lag_max > 0:
+        janelas = np.lib.stride_tricks.sliding_window_view(valores[:-1], lag_max)
+        matriz[:, 7:7 + lag_max] = janelas[inicio - lag_max:, ::-1]
+
+    # Janela móvel sobre os valores anteriores (shift(1)), com min_periods=1
+    soma_acum = np.concatenate(([0.0], np.cumsum(valores)))
+    soma_quad_acum = np.concatenate(([0.0], np.cumsum(valores * valores)))
+    primeiros = np.maximum(linhas - janela_movel, 0)
+    contagem = linhas - primeiros
+    soma = soma_acum[linhas] - soma_acum[primeiros]
+    soma_quadrados = soma_quad_acum[linhas] - soma_quad_acum[primeiros]
+    media = soma / contagem
+    variancia = np.maximum((soma_quadrados - soma * media) / (contagem - 1), 0.0)
+    matriz[:, 7 + lag_max] = media
+    matriz[:, 8 + lag_max] = np.sqrt(variancia)
+
+    return matriz, colunas
+
+def numero_dia(data):
+    """Converte uma data (Timestamp/datetime) no número de dias desde 1970-01-01."""
+    return int(np.datetime64(pd.Timestamp(data).normalize(), 'D').astype(np.int64))
+
+class BufferFeaturesRecursivas:
+    """
+    Buffer circular de tamanho fixo com os últimos `max(lag_max, janela_movel)` valores
+    diários, usado na previsão recursiva (um dia de cada vez).
+
+    A cada passo os lags são lidos direto do buffer e a média/desvio padrão móveis são
+    mantidos por soma e soma dos quadrados da janela, então o custo por dia previsto é
+    O(1). As features produzidas seguem a mesma ordem e definição de
+    `criar_features_temporais` (janela deslocada em 1 dia, std amostral).
+    """
+    def __init__(self, valores_recentes, lag_max=7, janela_movel=7):
+        self.lag_max = lag_max
+        self.janela_movel = janela_movel
+        self.tamanho = max(lag_max, janela_movel, 1)
+        recentes = np.asarray(valores_recentes, dtype=float)[-self.tamanho:]
+
+        self._valores = np.zeros(self.tamanho)
+        self._valores[:len(recentes)] = recentes
+        self._total = len(recentes) # Quantos valores válidos já passaram pelo buffer
+        self._pos = len(recentes) % self.tamanho # Próxima posição a ser escrita (a mais antiga)
+
+        janela = recentes[-janela_movel:]
+        self._n_janela = len(janela)
+        self._soma = float(np.sum(janela))
+        self._soma_quadrados = float(np.sum(janela * janela))
+
+        # Linha reutilizada em todas as chamadas a predict
+        self._linha = np.zeros((1, 6 + lag_max + 2))
+
+    def _lag(self, k):
+        return self._valores[(self._pos - k) % self.tamanho]
+
+    def atualizar_linha(self, dia, calendario=None):
+        """
+        Preenche a linha de features para o número de dia `dia` (o dia seguinte ao último
+        valor do buffer). `calendario` é a linha de `calendario_por_numero_dia` desse dia,
+        se já calculada.
+        """
+        linha = self._linha[0]
+        linha[0:6] = calendario_por_numero_dia([dia])[0] if calendario is None else calendario
+        for k in range(1, self.lag_max + 1):
+            linha[5 + k] = self._lag(k)
+        n = self._n_janela
+        media = self._soma / n
+        variancia = max(0.0, (self._soma_quadrados - self._soma * media) / (n - 1))
+        linha[6 + self.lag_max] = media
+        linha[7 + self.lag_max] = np.sqrt(variancia)
+        return self._linha
+
+    def adicionar(self, valor):
+        """Empurra um novo valor diário, atualizando a janela móvel em O(1)."""
+        if self._n_janela == self.janela_movel:
+            saindo = self._lag(self.janela_movel)
+            self._soma -= saindo
+            self._soma_quadrados -= saindo * saindo
+        else:
+            self._n_janela += 1
+        self._soma += valor
+        self._soma_quadrados += valor * valor
+        self._valores[self._pos] = valor
+        self._pos = (self._pos + 1) % self.tamanho
+        self._total += 1
+
+    def prever(self, modelo, ultimo_dia, dias_para_prever, linhas=None):
+        """
+        Previsão recursiva: prevê um dia, realimenta o buffer com o valor previsto e repete.
+
+        Args:
+            ultimo_dia (int): Número do dia (dias desde 1970-01-01) do último valor do buffer.
+            linhas (list, optional): Recebe uma cópia de cada linha de features usada (e.g.,
+                                     para `intervalo_floresta`).
+
+        Returns:
+            list: Previsões diárias (arredondadas a 4 casas, não negativas).
+        """
+        previsoes = []
+        calendario = calendario_por_numero_dia(np.arange(ultimo_dia + 1, ultimo_dia + 1 + dias_para_prever))
+        for passo in range(dias_para_prever):
+            if self._total < self.lag_max or self._n_janela < 2:
+                print(f"Alerta: Histórico insuficiente no buffer para prever {np.datetime64(ultimo_dia + 1 + passo, 'D')}. Interrompendo previsão iterativa.")
+                break
+            linha = self.atualizar_linha(ultimo_dia + 1 + passo, calendario[passo])
+            if linhas is not None:
+                linhas.append(linha[0].copy())
+            previsao_dia = modelo.predict(linha)[0]
+            previsao_dia = max(0, round(previsao_dia, 4)) # Arredondar e garantir não negativo
+            previsoes.append(previsao_dia)
+            self.adicionar(previsao_dia)
+        return previsoes
+
+    def prever_direto(self, modelo, ultimo_dia):
+        """
+        Previsão direta: um único predict de um modelo multi-saída (uma saída por dia do horizonte).
+
+        Returns:
+            list: Previsões diárias (arredondadas a 4 casas, não negativas).
+        """
+        previsoes = modelo.predict(self.atualizar_linha(ultimo_dia + 1)).reshape(-1)
+        return [max(0, round(float(valor), 4)) for valor in previsoes]
+
+def alvos_multi_horizonte(valores, horizonte):
+    """
+    Alvos da estratégia direta: a linha i contém os valores dos dias i, i+1, ..., i+horizonte-1.
+
+    Só existem linhas completas para os primeiros `len(valores) - horizonte + 1` dias,
+    então as linhas de features usadas no treino devem ser cortadas no mesmo tamanho.
+    """
+    valores = np.asarray(valores)
+    if len(valores) < horizonte:
+        return np.empty((0, horizonte), dtype=valores.dtype)
+    return np.lib.stride_tricks.sliding_window_view(valores, horizonte)
+
+def _alvos_para_fit(Y):
+    """Com horizonte 1 o sklearn espera y unidimensional."""
+    return Y if Y.shape[1] > 1 else Y[:, 0]
+
+# --- Janela de Treino ---
+# Com anos de histórico o custo do fit cresce sem parar, mas os dados antigos pouco acrescentam.
+# 'completa': todas as linhas; 'ultimos_dias': só as DIAS_JANELA_TREINO mais recentes;
+# 'decaimento': pesos (sample_weight) que caem pela metade a cada MEIA_VIDA_TREINO dias,
+# descartando as linhas com peso abaixo de PESO_MINIMO_TREINO; 'semanal': as linhas anteriores
+# aos CORTE_SEMANAL_TREINO dias mais recentes viram uma linha por semana, com peso 7: o alvo é a
+# média da semana e as features são as de um dia real dela (calendário e lags inteiros, como na
+# previsão), alternando o dia da semana de uma semana para a outra.
+JANELA_TREINO = 'completa'
+JANELAS_TREINO = ('completa', 'ultimos_dias', 'decaimento', 'semanal')
+DIAS_JANELA_TREINO = 365
+MEIA_VIDA_TREINO = 90
+PESO_MINIMO_TREINO = 0.01 # ~6,6 meias-vidas (~600 dias com MEIA_VIDA_TREINO = 90)
+CORTE_SEMANAL_TREINO = 365
+
+def parametro_janela_treino(politica):
+    """Parâmetro que define a janela (entra na chave do cache de modelos)."""
+    return {'completa': None, 'ultimos_dias': DIAS_JANELA_TREINO, 'decaimento': MEIA_VIDA_TREINO,
+            'semanal': CORTE_SEMANAL_TREINO}[politica]
+
+def aplicar_janela_treino(X, y, politica=None):
+    """
+    Restringe (ou resume) as linhas de treino conforme a política de janela, mais
+    recentes por último. `y` pode ter uma coluna por dia do horizonte (estratégia direta).
+
+    Returns:
+        tuple: (X, y, pesos para o fit ou None, descrição da janela para a resposta).
+    """
+    politica = politica or JANELA_TREINO
+    if politica not in JANELAS_TREINO:
+        raise ValueError(f"Política de janela de treino inválida: '{politica}'.")
+    n = len(X)
+    pesos = None
+    detalhes = {}
+    if politica == 'ultimos_dias':
+        X, y = X[-DIAS_JANELA_TREINO:], y[-DIAS_JANELA_TREINO:]
+        detalhes = {'dias': DIAS_JANELA_TREINO}
+    elif politica == 'decaimento':
+        pesos = 0.5 ** (np.arange(n - 1, -1, -1) / MEIA_VIDA_TREINO)
+        mantidas = int(np.count_nonzero(pesos >= PESO_MINIMO_TREINO))
+        X, y, pesos = X[-mantidas:], y[-mantidas:], pesos[-mantidas:]
+        detalhes = {'meia_vida_dias': MEIA_VIDA_TREINO}
+    elif politica == 'semanal':
+        antigas = max(0, n - CORTE_SEMANAL_TREINO)
+        detalhes = {'corte_dias': CORTE_SEMANAL_TREINO, 'semanas_agregadas': 0}
+        if antigas:
+            inicios = np.arange(0, antigas, 7)
+            contagens = np.diff(np.append(inicios, antigas)).astype(float)
+            # Média de features de calendário (dia da semana, mês...) não seria um dia válido
+            X_semanal = X[inicios + np.arange(len(inicios)) % contagens.astype(int)]
+            y_semanal = np.add.reduceat(y[:antigas], inicios, axis=0) / (contagens if y.ndim == 1 else contagens[:, None])
+            X, y = np.concatenate([X_semanal, X[antigas:]]), np.concatenate([y_semanal, y[antigas:]])
+            pesos = np.concatenate([contagens, np.ones(n - antigas)])
+            detalhes['semanas_agregadas'] = len(inicios)
+    return X, y, pesos, {'politica': politica, **detalhes, 'linhas_treino': len(X), 'linhas_disponiveis': n}
+
+# --- Seleção Automática de Modelo por Item (backtest com origens móveis) ---
+# Candidatos em ordem crescente de custo. Na previsão usamos o mais barato cujo erro
+# no backtest fique dentro de TOLERANCIA_SELECAO do melhor erro.
+MODELOS_CANDIDATOS = ('media', 'ses', 'hist_gradient_boosting', 'random_forest')
+TOLERANCIA_SELECAO = 0.05 # 5% acima do melhor erro
+ORIGENS_BACKTEST = 3 # Quantos horizontes (mais recentes) são usados como teste
+
+def criar_regressor(nome='random_forest'):
+    """Cria o regressor (não treinado) usado pelos modelos 'random_forest' e 'hist_gradient_boosting'."""
+    if nome == 'hist_gradient_boosting':
+        return HistGradientBoostingRegressor(max_iter=100, max_depth=6, random_state=42)
+    if nome == 'random_forest':
+        # Considerar ajustar hiperparâmetros se necessário
+        return RandomForestRegressor(n_estimators=100, random_state=42, max_depth=10, min_samples_split=5)
+    raise ValueError(f"Regressor desconhecido: '{nome}'.")
+
+def prever_total_modelo(valores, dia_inicial, dias_para_prever, modelo, lag_max=7, janela_movel=7):
+    """
+    Previsão total do horizonte para a série diária `valores` com um dos MODELOS_CANDIDATOS,
+    treinando do zero (usado no backtest).
+
+    Returns:
+        float: Previsão total, ou None se a série for curta demais para o modelo.
+    """
+    valores = np.asarray(valores, dtype=float)
+    if modelo == 'media':
+        return valores.mean() * dias_para_prever
+    if modelo == 'ses':
+        return max(0.0, taxa_ses(valores)) * dias_para_prever
+
+    matriz, _ = criar_features_temporais_np(valores, dia_inicial, lag_max=lag_max, janela_movel=janela_movel)
+    if len(matriz) < 10:
+        return None
+    X, y, pesos, _ = aplicar_janela_treino(matriz[:, 1:], matriz[:, 0])
+    regressor = para_floresta_plana(treinar_modelo(criar_regressor(modelo), X, y, n_jobs=1, pesos=pesos))
+    buffer = BufferFeaturesRecursivas(matriz[:, 0], lag_max=lag_max, janela_movel=janela_movel)
+    previsoes = buffer.prever(regressor, dia_inicial + len(valores) - 1, dias_para_prever)
+    return sum(previsoes) if len(previsoes) == dias_para_prever else None
+
+def backtest_item(valores, dia_inicial, dias_para_prever=7, origens=ORIGENS_BACKTEST, modelos=MODELOS_CANDIDATOS):
+    """
+    Backtest com origens móveis: para cada uma das últimas `origens` janelas de
+    `dias_para_prever` dias, treina com tudo que vem antes e compara a previsão total
+    com o consumo real da janela.
+
+    Returns:
+        tuple: (dict modelo -> erro absoluto médio (MAE) do total previsto, número de
+               origens usadas). Só entram modelos avaliados em todas as origens.
+    """
+    valores = np.asarray(valores, dtype=float)
+    erros = {modelo: [] for modelo in modelos}
+    origens_validas = 0
+    for k in range(origens, 0, -1):
+        corte = len(valores) - k * dias_para_prever
+        if corte < 2:
+            continue
+        origens_validas += 1
+        real = valores[corte:corte + dias_para_prever].sum()
+        for modelo in modelos:
+            previsto = prever_total_modelo(valores[:corte], dia_inicial, dias_para_prever, modelo)
+            if previsto is not None:
+                erros[modelo].append(abs(previsto - real))
+    erros_medios = {modelo: float(np.mean(lista)) for modelo, lista in erros.items()
+                    if origens_validas and len(lista) == origens_validas}
+    return erros_medios, origens_validas
+
+def selecionar_modelo_item(valores, dia_inicial, dias_para_prever=7, tolerancia=TOLERANCIA_SELECAO):
+    """
+    Escolhe o modelo de previsão do item: o mais barato (ordem de MODELOS_CANDIDATOS)
+    cujo erro de backtest não passa do melhor erro em mais de `tolerancia`.
+
+    Returns:
+        dict: 'modelo' (escolhido, ou None se o histórico não permitir backtest),
+              'melhor_modelo', 'erros' (MAE por modelo) e 'origens'.
+    """
+    erros, origens = backtest_item(valores, dia_inicial, dias_para_prever)
+    if not erros:
+        return {'modelo': None, 'melhor_modelo': None, 'erros': {}, 'origens': 0}
+    melhor = min(erros, key=erros.get)
+    limite = erros[melhor] * (1 + tolerancia) + 1e-9
+    escolhido = next(modelo for modelo in MODELOS_CANDIDATOS if modelo in erros and erros[modelo] <= limite)
+    return {'modelo': escolhido, 'melhor_modelo': melhor, 'erros': erros, 'origens': origens}
+
+def executar_selecao_modelos(series, dias_para_prever=7, max_workers=None):
+    """
+    Job (offline) de seleção de modelos: roda `selecionar_modelo_item` para cada item
+    em paralelo, em processos separados.
+
+    Args:
+        series (dict): item_id -> (valores diários, número do dia do primeiro valor).
+        max_workers (int, optional): Número de processos.
+
+    Returns:
+        dict: item_id -> resultado de `selecionar_modelo_item` (itens com erro ficam de fora).
+    """
+    resultados = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futuros = {pool.submit(selecionar_modelo_item, valores, dia_inicial, dias_para_prever): item_id
+                   for item_id, (valores, dia_inicial) in series.items()}
+        for futuro in as_completed(futuros):
+            item_id = futuros[futuro]
+            try:
+                resultados[item_id] = futuro.result()
+            except Exception as e:
+                print(f"Erro na seleção de modelo do item {item_id}: {e}")
+    return resultados
+
+def serie_consumo_diario(df_consumo_diario):
+    """
+    Monta a série diária contínua a partir dos totais por dia já agregados no banco
+    (tabela 'consumo_diario'), sem converter cada consumo com pd.to_datetime.
+
+    Args:
+        df_consumo_diario (pd.DataFrame): DataFrame com colunas 'dia' (número do dia, dias desde
+                                          1970-01-01, ou texto 'YYYY-MM-DD') e 'quantidade'.
+
+    Returns:
+        pd.Series: Consumo por dia (dias sem consumo = 0). Vazia se não houver dias.
+    """
+    if df_consumo_diario.empty:
+        return pd.Series(dtype=float)
+    numeros = df_consumo_diario['dia'].to_numpy()
+    if not np.issubdtype(numeros.dtype, np.integer):
+        numeros = numeros.astype(object).astype('datetime64[D]')
+    valores, inicio = valores_diarios_de_arrays(numeros.astype(np.int64), df_consumo_diario['quantidade'].to_numpy(dtype=float))
+    return pd.Series(valores, index=pd.date_range(pd.Timestamp(inicio, unit='D'), periods=len(valores), freq='D'))
+
+def valores_diarios_de_arrays(dias, quantidades):
+    """
+    Série diária contínua (dias sem consumo = 0) a partir de totais por número de dia.
+
+    Args:
+        dias (np.ndarray): Números de dia (dias desde 1970-01-01), inteiros, em qualquer ordem.
+        quantidades (np.ndarray): Quantidade de cada dia (dias repetidos são somados).
+
+    Returns:
+        tuple: (valores float64, número do dia do primeiro valor).
+    """
+    dias = np.asarray(dias, dtype=np.int64)
+    inicio = int(dias.min())
+    return np.bincount(dias - inicio, weights=np.asarray(quantidades, dtype=float)), inicio
+
+def agregar_consumo_diario(df_historico_consumo):
+    """
+    Converte o histórico de consumo na série diária contínua usada pelos modelos.
+
+    Args:
+        df_historico_consumo (pd.DataFrame): Consumos brutos (colunas 'data_consumo' (ISO) e 'quantidade')
+                                             ou totais diários (colunas 'dia' e 'quantidade').
+
+    Returns:
+        pd.Series: Consumo por dia (dias sem consumo = 0). Vazia se não houver datas válidas.
+    """
+    if 'dia' in df_historico_consumo.columns:
+        return serie_consumo_diario(df_historico_consumo)
+    if df_historico_consumo.empty:
+        return pd.Series(dtype=float)
+    datas = pd.to_datetime(df_historico_consumo['data_consumo'], format='ISO8601', errors='coerce')
+    validas = datas.notna().to_numpy()
+    serie = pd.Series(df_historico_consumo['quantidade'].to_numpy(dtype=float)[validas], index=pd.DatetimeIndex(datas[validas]))
+    return serie.resample('D').sum().fillna(0)
+
+# --- Modelo Global (um único modelo treinado com todos os itens) ---
+COLUNAS_DESCRITORES_ITEM = ['item_media', 'item_std', 'item_fracao_dias_consumo', 'item_dias_historico']
+
+def _descritores_item(valores):
+    """Descritores do item (constantes em todas as linhas dele) para o modelo global."""
+    return np.array([
+        valores.mean(),
+        valores.std(),
+        np.count_nonzero(valores) / len(valores),
+        len(valores),
+    ], dtype=np.float32)
+
+def obter_previsoes_globais(historicos, dias_para_prever=7, versoes=None, n_jobs=-1, estrategia=None):
+    """
+    Obtém a previsão de consumo de vários itens com um único RandomForest treinado
+    com as features de todos eles (modo "global", alternativo ao modelo por item).
+
+    As matrizes de `criar_features_temporais_np` de cada item são empilhadas, com
+    descritores do item (média, desvio, fração de dias com consumo, dias de histórico)
+    como colunas extras. Itens com histórico curto são completados com zeros à
+    esquerda, então também recebem previsão do modelo. A previsão é feita para todos
+    os itens juntos: um único `predict` por dia previsto (estratégia recursiva) ou um
+    único `predict` para todo o horizonte (estratégia direta).
+
+    Args:
+        historicos (dict): item_id -> DataFrame com o histórico do item, bruto ('data_consumo')
+                           ou em totais diários ('dia'), ambos com 'quantidade'.
         dias_para_prever (int): Número de dias futuros a prever.
+        versoes (dict, optional): item_id -> versão do histórico. Se informado, o modelo
+                                  global é reutilizado do cache enquanto nenhuma versão mudar.
+        n_jobs (int): Paralelismo máximo do RandomForest (o governador pode conceder menos).
+        estrategia (str, optional): 'recursiva' ou 'direta' (padrão: ESTRATEGIA_PREVISAO).
 
     Returns:
-        dict: Dicionário contendo 'previsao', 'message', 'metodo'.
+        dict: item_id -> dicionário com 'previsao', 'message' e 'metodo' (mesmo formato
+              de `obter_previsao_sklearn`).
     """
-    # item_id_debug = "N/A" # Para mensagens de erro, ID não é passado diretamente
-    try:
-        if df_historico_consumo.empty:
-             return {'previsao': 0, 'message': 'Sem histórico de consumo.', 'metodo': 'N/A'}
+    estrategia = estrategia or ESTRATEGIA_PREVISAO
+    if estrategia not in ESTRATEGIAS_PREVISAO:
+        raise ValueError(f"Estratégia de previsão inválida: '{estrategia}'.")
+    lag_max = 7
+    janela_movel = 7
+    # Dias necessários para gerar ao menos uma linha de treino (com todos os alvos, na estratégia direta)
+    tamanho_minimo = max(lag_max, 2) + (dias_para_prever if estrategia == 'direta' else 1)
+    resultados = {}
+    itens = [] # (item_id, serie_diaria, descritores)
 
-        df = df_historico_consumo.copy()
+    for item_id, df_historico in historicos.items():
+        try:
+            serie = agregar_consumo_diario(df_historico)
+        except Exception as e:
+            print(f"Erro ao preparar histórico do item {item_id} para o modelo global: {e}")
+            serie = pd.Series(dtype=float)
+        if serie.empty:
+            resultados[item_id] = {'previsao': 0, 'message': 'Sem histórico de consumo.', 'metodo': 'N/A'}
+            continue
+        if len(serie) < tamanho_minimo: # Completa com zeros antes do primeiro consumo
+            inicio = serie.index[-1] - pd.Timedelta(days=tamanho_minimo - 1)
+            serie = serie.reindex(pd.date_range(inicio, serie.index[-1], freq='D'), fill_value=0.0)
+        valores = serie.to_numpy(dtype=float)
+        itens.append((item_id, serie, _descritores_item(valores)))
+
+    if not itens:
+        return resultados
+
+    # --- Empilhar as features de todos os itens ---
+    blocos_X, blocos_y = [], []
+    for _, serie, descritores in itens:
+        matriz, _ = criar_features_temporais_np(serie.to_numpy(dtype=float), numero_dia(serie.index[0]), lag_max=lag_max, janela_movel=janela_movel)
+        if estrategia == 'direta':
+            alvos = alvos_multi_horizonte(matriz[:, 0], dias_para_prever)
+            matriz = matriz[:len(alvos)]
+        else:
+            alvos = matriz[:, 0]
+        blocos_X.append(np.hstack([matriz[:, 1:], np.broadcast_to(descritores, (len(matriz), len(descritores)))]))
+        blocos_y.append(alvos)
+    X = np.vstack(blocos_X)
+    y = np.concatenate(blocos_y)
+    if estrategia == 'direta':
+        y = _alvos_para_fit(y)
+
+    def _fallback_media(mensagem, metodo):
+        for item_id, serie, _ in itens:
+            media_hist = serie.mean() * dias_para_prever
+            resultados[item_id] = {'previsao': round(0 if pd.isna(media_hist) else media_hist, 2), 'message': mensagem, 'metodo': metodo}
+        return resultados
+
+    if len(X) < 10:
+        return _fallback_media('Dados históricos insuficientes para o modelo global. Usando média histórica.', 'Média Simples')
 
-        # --- CORREÇÃO APLICADA (Opção 1) ---
+    # --- Treinar (ou reutilizar) o modelo global ---
+    chave_cache = ('global', frozenset(versoes.items()), lag_max, janela_movel, estrategia, dias_para_prever) if versoes else None
+    modelo = cache_modelos.obter(chave_cache) if chave_cache is not None else None
+    modelo_em_cache = modelo is not None
+    if modelo is None:
+        modelo = criar_regressor('random_forest')
         try:
-            # Tentar converter para datetime, inferindo o formato ISO8601
-            # errors='coerce' transforma datas inválidas em NaT (Not a Time)
-            df['data_consumo'] = pd.to_datetime(df['data_consumo'], format='ISO8601', errors='coerce')
-
-            # Remover linhas onde a conversão falhou (se houver datas inválidas no DB)
-            linhas_invalidas = df['data_consumo'].isna().sum()
-            if linhas_invalidas > 0:
-                 print(f"Alerta: Removidas {linhas_invalidas} linhas com datas inválidas durante a conversão.")
-                 df = df.dropna(subset=['data_consumo'])
-
-            # Se todas as datas eram inválidas ou o dataframe ficou vazio
-            if df.empty:
-                raise ValueError("Nenhuma data válida encontrada após a conversão.")
-
-        except Exception as date_conv_error:
-            print(f"Erro crítico ao converter 'data_consumo' para datetime: {date_conv_error}")
+            treinar_modelo(modelo, X, y, n_jobs=n_jobs)
+        except Exception as fit_error:
+            print(f"Erro ao treinar modelo global: {fit_error}")
             traceback.print_exc()
-            # Fallback para média histórica se a conversão de data falhar
-            try:
-                media_hist_fallback = df_historico_consumo['quantidade'].mean() * dias_para_prever
-                media_hist_fallback = 0 if pd.isna(media_hist_fallback) else media_hist_fallback
-            except Exception: # Caso df_historico_consumo também tenha problemas
-                 media_hist_fallback = 0
-            return {'previsao': round(media_hist_fallback, 2), 'message': f'Erro crítico na conversão de data ({date_conv_error}). Usando média histórica.', 'metodo': 'Média (Erro Conversão Data)'}
-        # --- FIM DA CORREÇÃO ---
+            return _fallback_media(f'Erro no treinamento do modelo global ({fit_error}). Usando média.', 'Média (Erro Treino)')
+        modelo = para_floresta_plana(modelo)
+        if chave_cache is not None:
+            cache_modelos.guardar(chave_cache, modelo)
+
+    # --- Previsão vetorizada: uma linha por item ---
+    buffers = [BufferFeaturesRecursivas(serie.to_numpy(dtype=float), lag_max=lag_max, janela_movel=janela_movel) for _, serie, _ in itens]
+    descritores = np.vstack([d for _, _, d in itens])
+    dias = [numero_dia(serie.index[-1]) + 1 for _, serie, _ in itens]
+
+    if estrategia == 'direta':
+        # Um único predict para todos os itens e todos os dias
+        linhas = np.vstack([buffer.atualizar_linha(dia) for buffer, dia in zip(buffers, dias)])
+        previsoes = modelo.predict(np.hstack([linhas, descritores])).reshape(len(itens), dias_para_prever)
+        previsoes = np.maximum(0, np.round(previsoes, 4))
+    else:
+        # Um predict por dia previsto, realimentando os buffers
+        previsoes = np.zeros((len(itens), dias_para_prever))
+        for passo in range(dias_para_prever):
+            linhas = np.vstack([buffer.atualizar_linha(dia) for buffer, dia in zip(buffers, dias)])
+            previsoes_dia = np.maximum(0, np.round(modelo.predict(np.hstack([linhas, descritores])), 4))
+            previsoes[:, passo] = previsoes_dia
+            for buffer, valor in zip(buffers, previsoes_dia):
+                buffer.adicionar(float(valor))
+            dias = [dia + 1 for dia in dias]
 
-        df = df.set_index('data_consumo')
+    nome_metodo = f'{nome_modelo(modelo)} (Global)'
+    for (item_id, _, _), previsoes_item in zip(itens, previsoes):
+        resultados[item_id] = {
+            'previsao': round(float(previsoes_item.sum()), 2),
+            'message': f'Previsão ({dias_para_prever}/{dias_para_prever} dias) gerada com modelo global ({len(itens)} itens).',
+            'metodo': nome_metodo,
+            'modelo_em_cache': modelo_em_cache,
+        }
+    return resultados
 
-        # Agregar por dia e preencher dias sem consumo com 0
-        df_diario = df['quantidade'].resample('D').sum().fillna(0)
+def _prever_valores_diarios(valores, dia_inicial, dias_para_prever=7, item_id=None, versao_historico=None, n_jobs=-1, estrategia=None, camada_rapida=None, modelo_preferido=None, janela_treino=None):
+    """
+    Núcleo comum de `obter_previsao_sklearn` e `obter_previsao_arrays`: previsão a partir
+    da série diária contínua (NumPy) `valores`, cujo primeiro dia é `dia_inicial`.
+    Erros inesperados são propagados para o fallback de quem chamou.
+    """
+    valores = np.asarray(valores, dtype=float)
+    if modelo_preferido is not None and modelo_preferido not in MODELOS_CANDIDATOS:
+        raise ValueError(f"Modelo preferido inválido: '{modelo_preferido}'.")
 
-        # --- Engenharia de Features ---
-        lag_max = 7
-        janela_movel = 7
-        df_com_features = criar_features_temporais(df_diario.to_frame(), lag_max=lag_max, janela_movel=janela_movel) # Passa df_diario
+    # --- Modelos simples escolhidos pela seleção por backtest ---
+    if modelo_preferido in ('media', 'ses'):
+        previsao_total = prever_total_modelo(valores, dia_inicial, dias_para_prever, modelo_preferido)
+        nome_metodo = 'Média Simples' if modelo_preferido == 'media' else METODOS_CAMADA_RAPIDA['ses'][0]
+        return {'previsao': round(previsao_total, 2), 'message': f'Previsão gerada com {nome_metodo} (modelo selecionado por backtest).', 'metodo': nome_metodo,
+                **intervalo_taxa(valores, previsao_total, dias_para_prever)}
 
-        if df_com_features.empty or len(df_com_features) < 10: # Exige um mínimo de dados após criar features
-             media_hist = df_diario.mean() * dias_para_prever
-             media_hist = 0 if pd.isna(media_hist) else media_hist
-             return {'previsao': round(media_hist, 2), 'message': 'Dados históricos insuficientes para modelo ML (após feature eng.). Usando média histórica.', 'metodo': 'Média Simples'}
+    # --- Camada rápida: séries curtas ou intermitentes não justificam a floresta ---
+    if modelo_preferido is None and (USAR_CAMADA_RAPIDA if camada_rapida is None else camada_rapida):
+        metodo_rapido, motivo = escolher_camada_rapida(valores)
+        if metodo_rapido is not None:
+            previsao_total, nome_metodo = prever_camada_rapida(valores, dias_para_prever, metodo_rapido)
+            return {'previsao': round(previsao_total, 2), 'message': f'Previsão gerada com {nome_metodo}: {motivo}.', 'metodo': nome_metodo,
+                    **intervalo_taxa(valores, previsao_total, dias_para_prever)}
 
-        # --- Preparar para Treinamento ---
-        X = df_com_features.drop('quantidade', axis=1)
-        y = df_com_features['quantidade']
+    # --- Engenharia de Features (versão NumPy de criar_features_temporais) ---
+    lag_max = 7
+    janela_movel = 7
+    matriz_features, colunas_features = criar_features_temporais_np(
+        valores, dia_inicial, lag_max=lag_max, janela_movel=janela_movel)
 
-        # --- Escolher e Treinar o Modelo ---
-        # Considerar ajustar hiperparâmetros se necessário
-        modelo = RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=-1, max_depth=10, min_samples_split=5)
+    if len(matriz_features) < 10: # Exige um mínimo de dados após criar features
+         media_hist = valores.mean() * dias_para_prever
+         return {'previsao': round(float(media_hist), 2), 'message': 'Dados históricos insuficientes para modelo ML (após feature eng.). Usando média histórica.', 'metodo': 'Média Simples',
+                 **intervalo_taxa(valores, media_hist, dias_para_prever)}
+
+    # --- Preparar para Treinamento ---
+    X = matriz_features[:, 1:]
+    y = matriz_features[:, 0]
+
+    nome_regressor = modelo_preferido or 'random_forest'
+    estrategia = estrategia or ESTRATEGIA_PREVISAO
+    if estrategia not in ESTRATEGIAS_PREVISAO:
+        raise ValueError(f"Estratégia de previsão inválida: '{estrategia}'.")
+    if estrategia == 'direta' and nome_regressor != 'random_forest':
+        estrategia = 'recursiva' # Só a floresta tem saída múltipla nativa
+    if estrategia == 'direta':
+        alvos_diretos = alvos_multi_horizonte(y, dias_para_prever)
+        if len(alvos_diretos) < 10: # Cada linha precisa de todos os dias do horizonte
+            print(f"Alerta: Histórico curto para a estratégia direta ({len(alvos_diretos)} linhas). Usando estratégia recursiva.")
+            estrategia = 'recursiva'
+        else:
+            X_treino, y_treino = X[:len(alvos_diretos)], _alvos_para_fit(alvos_diretos)
+    if estrategia == 'recursiva':
+        X_treino, y_treino = X, y
+    X_treino, y_treino, pesos_treino, descricao_janela = aplicar_janela_treino(X_treino, y_treino, janela_treino)
+
+    # --- Escolher e Treinar o Modelo (ou reutilizar do cache) ---
+    chave_cache = None
+    if item_id is not None and versao_historico is not None:
+        chave_cache = (item_id, versao_historico, nome_regressor, lag_max, janela_movel, estrategia, dias_para_prever if estrategia == 'direta' else None,
+                       descricao_janela['politica'], parametro_janela_treino(descricao_janela['politica']))
+    modelo = cache_modelos.obter(chave_cache) if chave_cache is not None else None
+    if modelo is None and chave_cache is not None and PERSISTIR_MODELOS:
+        modelo = repositorio_modelos.carregar(item_id, chave_cache) # Modelo salvo antes de um reinício
+        if modelo is not None:
+            modelo = para_floresta_plana(modelo) # Floresta gravada antes da exportação para arrays planos
+            cache_modelos.guardar(chave_cache, modelo)
+    modelo_em_cache = modelo is not None
+
+    if modelo is None:
+        modelo = criar_regressor(nome_regressor)
         try:
-            modelo.fit(X, y)
+            treinar_modelo(modelo, X_treino, y_treino, n_jobs=n_jobs, pesos=pesos_treino)
         except Exception as fit_error:
-             print(f"Erro ao treinar modelo RandomForest: {fit_error}")
+             print(f"Erro ao treinar modelo {nome_modelo(modelo)}: {fit_error}")
              traceback.print_exc()
-             media_hist = df_diario.mean() * dias_para_prever
-             media_hist = 0 if pd.isna(media_hist) else media_hist
-             return {'previsao': round(media_hist, 2), 'message': f'Erro no treinamento do modelo ({fit_error}). Usando média.', 'metodo': 'Média (Erro Treino)'}
-
-        # --- Previsão Iterativa para o Futuro ---
-        previsoes_futuras_lista = []
-        df_hist_features_recente = df_com_features.copy() # Começa com o histórico que tem features
-
-        for i in range(dias_para_prever):
-            # Preparar features para a próxima data
-            ultima_data_hist = df_hist_features_recente.index.max()
-            proxima_data = ultima_data_hist + pd.Timedelta(days=1)
-
-            # Criar df temporário até a próxima data com placeholder
-            # Usar apenas a coluna 'quantidade' para recalcular features
-            df_temp_para_features = df_hist_features_recente[['quantidade']].copy()
-            df_temp_para_features.loc[proxima_data] = 0 # Placeholder para a data a prever
-
-            # Recalcular features para todo o conjunto temporário
-            df_features_calculadas = criar_features_temporais(df_temp_para_features, lag_max=lag_max, janela_movel=janela_movel)
-
-            # Verificar se o cálculo de features retornou algo (pode falhar se poucos dados)
-            if df_features_calculadas.empty:
-                print(f"Alerta: Cálculo de features para data futura {proxima_data} retornou vazio. Interrompendo previsão iterativa.")
-                # Retornar a previsão acumulada até agora ou 0? Vamos retornar o acumulado.
-                break # Sai do loop de previsão futura
-
-            # Pegar apenas a linha da data que queremos prever
-            features_proxima_data = df_features_calculadas.drop('quantidade', axis=1).tail(1)
-
-            # Garantir colunas na ordem correta e que existem (preencher faltantes com 0)
-            # Isso é crucial se o df_features_calculadas for mais curto que X.columns
-            features_prontas_para_previsao = pd.DataFrame(0, index=features_proxima_data.index, columns=X.columns)
-            # Copiar colunas existentes
-            colunas_comuns = X.columns.intersection(features_proxima_data.columns)
-            features_prontas_para_previsao[colunas_comuns] = features_proxima_data[colunas_comuns]
-
-            # Fazer previsão
-            previsao_dia = modelo.predict(features_prontas_para_previsao)[0]
-            previsao_dia = max(0, round(previsao_dia, 4)) # Arredondar e garantir não negativo
-            previsoes_futuras_lista.append(previsao_dia)
+             media_hist = valores.mean() * dias_para_prever
+             return {'previsao': round(float(media_hist), 2), 'message': f'Erro no treinamento do modelo ({fit_error}). Usando média.', 'metodo': 'Média (Erro Treino)',
+                     **intervalo_taxa(valores, media_hist, dias_para_prever)}
+        # Cache e disco guardam a floresta já em arrays planos: a previsão não passa pelo sklearn
+        modelo = para_floresta_plana(modelo)
+        if chave_cache is not None:
+            cache_modelos.guardar(chave_cache, modelo)
+            if PERSISTIR_MODELOS:
+                repositorio_modelos.salvar(item_id, chave_cache, modelo, versao_historico)
+
+    # --- Previsão para o Futuro ---
+    # Buffer circular com os últimos valores: cada dia previsto (recursiva) custa O(1),
+    # sem recalcular features sobre todo o histórico. Na direta há um único predict.
+    buffer = BufferFeaturesRecursivas(y, lag_max=lag_max, janela_movel=janela_movel)
+    ultimo_dia = dia_inicial + len(valores) - 1
+    linhas_previsao = []
+    if estrategia == 'direta':
+        previsoes_futuras_lista = buffer.prever_direto(modelo, ultimo_dia)
+        linhas_previsao.append(buffer.atualizar_linha(ultimo_dia + 1)[0].copy())
+    else:
+        previsoes_futuras_lista = buffer.prever(modelo, ultimo_dia, dias_para_prever, linhas=linhas_previsao)
 
-            # Atualizar o histórico com a previsão feita para a PRÓXIMA iteração
-            novo_registro_hist = features_prontas_para_previsao.copy()
-            novo_registro_hist['quantidade'] = previsao_dia # Adiciona a coluna 'quantidade' prevista
-            novo_registro_hist.index = [proxima_data] # Define o índice correto
+    # --- Resultado Final ---
+    previsao_total = sum(previsoes_futuras_lista)
 
-            # Concatenar ao histórico recente
-            # Certificar-se de que as colunas estão alinhadas (pode precisar reordenar)
-            df_hist_features_recente = pd.concat([df_hist_features_recente, novo_registro_hist[df_hist_features_recente.columns]]) # Garante mesmas colunas
+    # Intervalo: árvores da floresta (mesmas linhas da previsão) ou bootstrap dos resíduos de treino
+    if not linhas_previsao:
+        intervalo = {}
+    elif isinstance(modelo, FlorestaPlana) or hasattr(modelo, 'estimators_'):
+        intervalo = intervalo_floresta(modelo, np.vstack(linhas_previsao))
+    else:
+        residuos = y_treino[-JANELA_RESIDUOS:] - modelo.predict(X_treino[-JANELA_RESIDUOS:])
+        intervalo = intervalo_bootstrap(previsao_total, residuos, len(previsoes_futuras_lista))
 
-        # --- Resultado Final ---
-        previsao_total = sum(previsoes_futuras_lista)
+    # Mensagem de sucesso mais informativa
+    msg_sucesso = f'Previsão ({len(previsoes_futuras_lista)}/{dias_para_prever} dias) gerada com {nome_modelo(modelo)}.'
+    if len(previsoes_futuras_lista) < dias_para_prever:
+         msg_sucesso += " Previsão pode ser parcial devido a dados insuficientes para o período completo."
 
-        # Mensagem de sucesso mais informativa
-        msg_sucesso = f'Previsão ({len(previsoes_futuras_lista)}/{dias_para_prever} dias) gerada com {type(modelo).__name__}.'
-        if len(previsoes_futuras_lista) < dias_para_prever:
-             msg_sucesso += " Previsão pode ser parcial devido a dados insuficientes para o período completo."
 
+    return {'previsao': round(previsao_total, 2), 'message': msg_sucesso, 'metodo': nome_modelo(modelo), 'modelo_em_cache': modelo_em_cache,
+            'janela_treino': descricao_janela, **intervalo}
 
-        return {'previsao': round(previsao_total, 2), 'message': msg_sucesso, 'metodo': type(modelo).__name__}
+def obter_previsao_sklearn(df_historico_consumo, dias_para_prever=7, item_id=None, versao_historico=None, n_jobs=-1, estrategia=None, camada_rapida=None, modelo_preferido=None, janela_treino=None):
+    """
+    Obtém a previsão de consumo usando scikit-learn, recebendo os dados históricos.
+
+    Args:
+        df_historico_consumo (pd.DataFrame): DataFrame com colunas 'data_consumo' e 'quantidade' (consumos
+                                             brutos) ou 'dia' e 'quantidade' (totais diários agregados no
+                                             banco; dispensa a conversão das datas e o resample).
+        dias_para_prever (int): Número de dias futuros a prever.
+        item_id (int, optional): ID do item. Junto com `versao_historico`, habilita o cache de modelos.
+        versao_historico (str, optional): Identificador da versão do histórico (muda a cada novo consumo).
+        n_jobs (int): Paralelismo máximo do RandomForest (-1 = o que o governador conceder,
+                      até ORCAMENTO_NUCLEOS). Use 1 quando a paralelização já é feita
+                      entre itens (e.g., previsão em lote).
+        estrategia (str, optional): 'recursiva' ou 'direta' (padrão: ESTRATEGIA_PREVISAO).
+        camada_rapida (bool, optional): Se históricos curtos/intermitentes usam os previsores
+                                        rápidos (Croston, SBA, TSB, SES) em vez da floresta
+                                        (padrão: USAR_CAMADA_RAPIDA).
+        modelo_preferido (str, optional): Modelo escolhido para o item pela seleção por
+                                          backtest (um de MODELOS_CANDIDATOS). Se informado,
+                                          substitui a escolha automática da camada rápida.
+        janela_treino (str, optional): Política de janela de treino, uma de JANELAS_TREINO
+                                       (padrão: JANELA_TREINO).
+
+    Returns:
+        dict: Dicionário contendo 'previsao', 'message', 'metodo' e, quando há histórico, o
+              intervalo do total previsto ('previsao_p10', 'previsao_p50', 'previsao_p90',
+              'metodo_intervalo'). Previsões de modelos treinados trazem também
+              'janela_treino' (política usada e linhas de treino).
+    """
+    # item_id_debug = "N/A" # Para mensagens de erro, ID não é passado diretamente
+    try:
+        if df_historico_consumo.empty:
+             return {'previsao': 0, 'message': 'Sem histórico de consumo.', 'metodo': 'N/A'}
+
+        if 'dia' in df_historico_consumo.columns:
+            # Totais diários já agregados no banco: só falta preencher os dias sem consumo
+            df_diario = serie_consumo_diario(df_historico_consumo)
+        else:
+            df = df_historico_consumo.copy()
+
+            # --- CORREÇÃO APLICADA (Opção 1) ---
+            try:
+                # Tentar converter para datetime, inferindo o formato ISO8601
+                # errors='coerce' transforma datas inválidas em NaT (Not a Time)
+                df['data_consumo'] = pd.to_datetime(df['data_consumo'], format='ISO8601', errors='coerce')
+
+                # Remover linhas onde a conversão falhou (se houver datas inválidas no DB)
+                linhas_invalidas = df['data_consumo'].isna().sum()
+                if linhas_invalidas > 0:
+                     print(f"Alerta: Removidas {linhas_invalidas} linhas com datas inválidas durante a conversão.")
+                     df = df.dropna(subset=['data_consumo'])
+
+                # Se todas as datas eram inválidas ou o dataframe ficou vazio
+                if df.empty:
+                    raise ValueError("Nenhuma data válida encontrada após a conversão.")
+
+            except Exception as date_conv_error:
+                print(f"Erro crítico ao converter 'data_consumo' para datetime: {date_conv_error}")
+                traceback.print_exc()
+                # Fallback para média histórica se a conversão de data falhar
+                try:
+                    media_hist_fallback = df_historico_consumo['quantidade'].mean() * dias_para_prever
+                    media_hist_fallback = 0 if pd.isna(media_hist_fallback) else media_hist_fallback
+                except Exception: # Caso df_historico_consumo também tenha problemas
+                     media_hist_fallback = 0
+                return {'previsao': round(media_hist_fallback, 2), 'message': f'Erro crítico na conversão de data ({date_conv_error}). Usando média histórica.', 'metodo': 'Média (Erro Conversão Data)'}
+            # --- FIM DA CORREÇÃO ---
+
+            df = df.set_index('data_consumo')
+
+            # Agregar por dia e preencher dias sem consumo com 0
+            df_diario = df['quantidade'].resample('D').sum().fillna(0)
+
+        return _prever_valores_diarios(df_diario.to_numpy(dtype=float), numero_dia(df_diario.index[0]), dias_para_prever,
+                                       item_id=item_id, versao_historico=versao_historico, n_jobs=n_jobs,
+                                       estrategia=estrategia, camada_rapida=camada_rapida, modelo_preferido=modelo_preferido,
+                                       janela_treino=janela_treino)
 
     except Exception as e:
         print(f"Erro GERAL não tratado ao obter previsão sklearn: {e}")
@@ -197,4 +1608,45 @@ def obter_previsao_sklearn(df_historico_consumo, dias_para_prever=7):
         except: # Se até a média falhar
              return {'previsao': 0, 'message': f'Erro crítico irrecuperável ({e}).', 'metodo': 'Erro'}
 
+def obter_previsao_arrays(dias, quantidades, dias_para_prever=7, item_id=None, versao_historico=None, n_jobs=-1, estrategia=None, camada_rapida=None, modelo_preferido=None, janela_treino=None):
+    """
+    Igual a `obter_previsao_sklearn`, mas recebendo o histórico como arrays NumPy de totais
+    diários (e.g., de `fetch_consumo_arrays_for_prediction`), sem DataFrame nem conversão de datas.
+
+    Args:
+        dias (np.ndarray): Números de dia (dias desde 1970-01-01) com consumo.
+        quantidades (np.ndarray): Consumo total de cada dia.
+        Demais argumentos: ver `obter_previsao_sklearn`.
+
+    Returns:
+        dict: Dicionário contendo 'previsao', 'message', 'metodo'.
+    """
+    try:
+        if len(dias) == 0:
+            return {'previsao': 0, 'message': 'Sem histórico de consumo.', 'metodo': 'N/A'}
+        valores, dia_inicial = valores_diarios_de_arrays(dias, quantidades)
+        return _prever_valores_diarios(valores, dia_inicial, dias_para_prever, item_id=item_id,
+                                       versao_historico=versao_historico, n_jobs=n_jobs, estrategia=estrategia,
+                                       camada_rapida=camada_rapida, modelo_preferido=modelo_preferido, janela_treino=janela_treino)
+    except Exception as e:
+        print(f"Erro GERAL não tratado ao obter previsão (arrays): {e}")
+        traceback.print_exc()
+        try:
+            media_geral = float(np.mean(quantidades)) * dias_para_prever if len(quantidades) else 0
+            return {'previsao': round(media_geral, 2), 'message': f'Erro crítico inesperado ({e}). Usando média histórica.', 'metodo': 'Média (Erro Crítico)'}
+        except Exception: # Se até a média falhar
+            return {'previsao': 0, 'message': f'Erro crítico irrecuperável ({e}).', 'metodo': 'Erro'}
+
+def prever_linha_de_base(dias, quantidades, dias_para_prever=7):
+    """
+    Previsão barata (SES sobre a série diária, sem treino) usada como resposta provisória
+    enquanto a previsão completa é calculada em segundo plano.
+    """
+    if len(dias) == 0:
+        return {'previsao': 0, 'message': 'Sem histórico de consumo.', 'metodo': 'N/A'}
+    valores, _ = valores_diarios_de_arrays(dias, quantidades)
+    previsao_total, nome_metodo = prever_camada_rapida(valores, dias_para_prever, 'ses')
+    return {'previsao': round(previsao_total, 2), 'message': f'Previsão provisória com {nome_metodo}; a previsão completa está sendo calculada.',
+            'metodo': nome_metodo, **intervalo_taxa(valores, previsao_total, dias_para_prever)}
+
 # --- END OF FILE helper_module.py ---
\ No newline at end of file
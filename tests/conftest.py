@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Os testes importam os módulos da raiz do projeto (helper_module, app)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,65 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'teste.db'))
+    app.init_db()
+    conexao = app.get_db_connection()
+    with conexao:
+        for nome in ('Arroz', 'Feijao', 'Sal'):
+            conexao.execute("INSERT INTO estoque (nome, quantidade, data_cadastro) VALUES (?, 10, '2025-01-01')", (nome,))
+    yield conexao
+    conexao.close()
+
+
+def _consumo_diario(conn):
+    return sorted(tuple(row) for row in conn.execute('SELECT item_id, dia, quantidade FROM consumo_diario'))
+
+
+def _soma_por_dia(conn):
+    return sorted(tuple(row) for row in conn.execute('''
+        SELECT item_id, dia_consumo, SUM(quantidade) FROM consumo
+        WHERE dia_consumo IS NOT NULL GROUP BY item_id, dia_consumo'''))
+
+
+def test_consumo_diario_acompanha_insercao_alteracao_e_exclusao(conn):
+    rng = random.Random(7)
+    base = datetime(2024, 12, 28, 0, 30)
+    with conn: # Só a data em texto (as colunas inteiras vêm dos triggers) ou com tempo_consumo
+        for _ in range(150):
+            data = base + timedelta(days=rng.randint(0, 9), hours=rng.randint(0, 23))
+            if rng.random() < 0.5:
+                conn.execute('INSERT INTO consumo (item_id, quantidade, data_consumo) VALUES (?, ?, ?)',
+                             (rng.randint(1, 3), rng.randint(1, 4), data.isoformat(timespec='seconds')))
+            else:
+                conn.execute('INSERT INTO consumo (item_id, quantidade, data_consumo, data_consumo_epoch, dia_consumo) VALUES (?, ?, ?, ?, ?)',
+                             (rng.randint(1, 3), rng.randint(1, 4), data.isoformat(timespec='seconds'), *app.tempo_consumo(data)))
+    assert _consumo_diario(conn) == _soma_por_dia(conn)
+
+    ids = [row[0] for row in conn.execute('SELECT id FROM consumo')]
+    with conn:
+        for consumo_id in rng.sample(ids, 30): # Quantidade
+            conn.execute('UPDATE consumo SET quantidade = ? WHERE id = ?', (rng.randint(1, 9), consumo_id))
+        for consumo_id in rng.sample(ids, 30): # Data (inclusive para outro dia e outro ano)
+            nova = base + timedelta(days=rng.randint(-3, 12), hours=rng.randint(0, 23))
+            conn.execute('UPDATE consumo SET data_consumo = ? WHERE id = ?', (nova.isoformat(timespec='seconds'), consumo_id))
+        for consumo_id in rng.sample(ids, 10): # Item
+            conn.execute('UPDATE consumo SET item_id = ? WHERE id = ?', (rng.randint(1, 3), consumo_id))
+    assert _consumo_diario(conn) == _soma_por_dia(conn)
+
+    with conn:
+        for consumo_id in rng.sample(ids, 60):
+            conn.execute('DELETE FROM consumo WHERE id = ?', (consumo_id,))
+    assert _consumo_diario(conn) == _soma_por_dia(conn)
+    assert all(quantidade > 0 for _, _, quantidade in _consumo_diario(conn))
+
+    with conn: # Exclusão do item: consumos removidos em cascata
+        conn.execute('DELETE FROM estoque WHERE id = 2')
+    assert _consumo_diario(conn) == _soma_por_dia(conn)
+    assert not any(item_id == 2 for item_id, _, _ in _consumo_diario(conn))
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import app
+import helper_module
+
+
+def test_governador_divide_o_orcamento_pelos_treinos_esperados():
+    governador = helper_module.GovernadorParalelismo(8, treinos_esperados=4)
+    with governador.nucleos() as primeiro:
+        with governador.nucleos() as segundo:
+            assert (primeiro, segundo) == (2, 2) # O primeiro treino não leva todos os núcleos
+    with governador.nucleos(maximo=1) as limitado:
+        assert limitado == 1
+    assert governador.estatisticas()['nucleos_livres'] == 8
+
+
+def test_governador_divide_pelos_treinos_ativos_acima_do_esperado():
+    governador = helper_module.GovernadorParalelismo(8, treinos_esperados=2)
+    with governador.nucleos(maximo=2) as primeiro:
+        with governador.nucleos() as segundo:
+            with governador.nucleos() as terceiro: # Três treinos ativos: 8 // 3
+                assert (primeiro, segundo, terceiro) == (2, 4, 2)
+                assert governador.estatisticas()['treinos_ativos'] == 3
+
+
+def test_governador_espera_com_tempo_limite():
+    governador = helper_module.GovernadorParalelismo(1, espera_maxima=0.2)
+    segurando = threading.Event()
+    liberar = threading.Event()
+
+    def treino_longo():
+        with governador.nucleos():
+            segurando.set()
+            liberar.wait(5)
+
+    thread = threading.Thread(target=treino_longo)
+    thread.start()
+    segurando.wait(5)
+    inicio = time.perf_counter()
+    with governador.nucleos() as concedidos:
+        espera = time.perf_counter() - inicio
+        assert concedidos == 1
+    liberar.set()
+    thread.join()
+
+    assert 0.15 <= espera < 2
+    estatisticas = governador.estatisticas()
+    assert estatisticas['esperas'] == 1 and estatisticas['esperas_esgotadas'] == 1
+    assert estatisticas['nucleos_livres'] == 1 and estatisticas['treinos_ativos'] == 0
+
+
+def _executar_em_threads(execucao, chave, funcao, quantidade):
+    """Chama execucao.executar(chave, funcao) em `quantidade` threads; retorna (resultados, exceções)."""
+    resultados, excecoes = [], []
+
+    def chamar():
+        try:
+            resultados.append(execucao.executar(chave, funcao))
+        except Exception as e:
+            excecoes.append(e)
+
+    threads = [threading.Thread(target=chamar) for _ in range(quantidade)]
+    for thread in threads:
+        thread.start()
+    return threads, resultados, excecoes
+
+
+def _aguardar_agrupadas(execucao, agrupadas):
+    limite = time.monotonic() + 5
+    while execucao.estatisticas()['agrupadas'] < agrupadas and time.monotonic() < limite:
+        time.sleep(0.005)
+
+
+def test_execucao_unica_compartilha_um_calculo_entre_as_threads():
+    execucao = app.ExecucaoUnica()
+    liberar = threading.Event()
+    chamadas = []
+
+    def calcular():
+        chamadas.append(1)
+        liberar.wait(5)
+        return {'previsao': 42}
+
+    threads, resultados, excecoes = _executar_em_threads(execucao, ('previsao', 1, 'v1'), calcular, 8)
+    _aguardar_agrupadas(execucao, 7) # Todas as threads chegaram com o cálculo em andamento
+    liberar.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(chamadas) == 1 and not excecoes
+    assert len(resultados) == 8 and all(resultado is resultados[0] for resultado in resultados)
+    assert execucao.estatisticas() == {'execucoes': 1, 'agrupadas': 7, 'em_andamento': 0}
+
+    # Terminado o cálculo, a mesma chave é calculada de novo
+    assert execucao.executar(('previsao', 1, 'v1'), lambda: 'novo') == 'novo'
+
+
+def test_execucao_unica_repassa_a_excecao_a_todos():
+    execucao = app.ExecucaoUnica()
+    liberar = threading.Event()
+    chamadas = []
+
+    def falhar():
+        chamadas.append(1)
+        liberar.wait(5)
+        raise app.ServidorOcupado()
+
+    threads, resultados, excecoes = _executar_em_threads(execucao, ('lote', 2, 'v1', None), falhar, 5)
+    _aguardar_agrupadas(execucao, 4)
+    liberar.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(chamadas) == 1 and not resultados
+    assert len(excecoes) == 5 and all(isinstance(e, app.ServidorOcupado) for e in excecoes)
+    assert execucao.estatisticas()['em_andamento'] == 0
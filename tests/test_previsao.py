@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import helper_module
+
+
+def _features_pandas(valores, dia_inicial, lag_max, janela_movel):
+    """Features da implementação de referência (pandas), nas colunas da versão NumPy."""
+    datas = pd.date_range(pd.Timestamp(np.datetime64(dia_inicial, 'D')), periods=len(valores), freq='D')
+    df = pd.DataFrame({'quantidade': np.asarray(valores, dtype=float)}, index=datas)
+    return helper_module.criar_features_temporais(df, lag_max=lag_max, janela_movel=janela_movel)
+
+
+def _comparar(valores, dia_inicial, lag_max, janela_movel):
+    matriz, colunas = helper_module.criar_features_temporais_np(valores, dia_inicial, lag_max, janela_movel)
+    df = _features_pandas(valores, dia_inicial, lag_max, janela_movel)
+
+    assert matriz.shape[0] == len(df)
+    if df.empty:
+        assert matriz.shape == (0, len(colunas))
+        return
+    assert sorted(colunas) == sorted(df.columns)
+    np.testing.assert_allclose(matriz, df[colunas].to_numpy(dtype=float), rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize('semente', range(20))
+def test_features_np_iguais_as_do_pandas_em_series_aleatorias(semente):
+    rng = np.random.default_rng(semente)
+    n = int(rng.integers(1, 400))
+    lag_max = int(rng.integers(0, 15))
+    janela_movel = int(rng.integers(2, 30))
+    dia_inicial = int(rng.integers(0, 25000)) # 1970 a ~2038
+    valores = rng.poisson(rng.uniform(0.5, 20), size=n) * rng.choice([1.0, 0.5])
+    _comparar(valores, dia_inicial, lag_max, janela_movel)
+
+
+@pytest.mark.parametrize('data_inicial', ['1998-12-20', '2004-12-20', '2015-12-21', '2020-12-21', '2021-12-27', '2026-12-21'])
+def test_features_np_nas_viradas_de_ano_e_semana_iso(data_inicial):
+    # Séries curtas que atravessam o ano novo: semana ISO 52/53 -> 1, ano ISO diferente do ano civil
+    dia_inicial = helper_module.numero_dia(data_inicial)
+    valores = np.random.default_rng(0).integers(0, 10, size=30).astype(float)
+    _comparar(valores, dia_inicial, lag_max=7, janela_movel=7)
+
+    calendario = helper_module.calendario_por_numero_dia(dia_inicial + np.arange(30))
+    datas = pd.date_range(data_inicial, periods=30, freq='D')
+    np.testing.assert_array_equal(calendario[:, 1], datas.isocalendar().week.astype(int).to_numpy())
+
+
+@pytest.mark.parametrize('lag_max, janela_movel', [(7, 1), (3, 0), (0, 1)])
+def test_features_np_vazias_com_janela_movel_menor_que_2(lag_max, janela_movel):
+    matriz, colunas = helper_module.criar_features_temporais_np(np.arange(50.0), 19000, lag_max, janela_movel)
+    assert matriz.shape == (0, len(colunas))
+    if janela_movel == 1: # rolling(window=0) não é aceito pelo pandas
+        assert _features_pandas(np.arange(50.0), 19000, lag_max, janela_movel).empty
+
+
+@pytest.mark.parametrize('n, lag_max', [(0, 7), (1, 7), (7, 7), (5, 7), (2, 0), (2, 1)])
+def test_features_np_vazias_sem_historico_suficiente(n, lag_max):
+    valores = np.arange(n, dtype=float)
+    matriz, colunas = helper_module.criar_features_temporais_np(valores, 19000, lag_max, 7)
+    assert matriz.shape == (0, len(colunas))
+    _comparar(valores, 19000, lag_max, 7)
+
+
+def _dados_floresta(n_saidas, semente=0):
+    rng = np.random.default_rng(semente)
+    X = rng.normal(size=(300, 9)) * [1, 10, 100, 1, 1, 1, 1000, 0.01, 1]
+    X[:, 3] = rng.integers(0, 7, size=300) # Feature discreta: linhas caindo exatamente no limiar
+    coeficientes = rng.normal(size=(9, n_saidas))
+    y = X @ coeficientes + rng.normal(size=(300, n_saidas))
+    return X, (y[:, 0] if n_saidas == 1 else y)
+
+
+@pytest.mark.parametrize('n_saidas', [1, 7]) # 7: estratégia direta (um modelo multi-saída para o horizonte)
+def test_floresta_plana_igual_a_random_forest(n_saidas):
+    X, y = _dados_floresta(n_saidas)
+    modelo = helper_module.RandomForestRegressor(n_estimators=15, max_depth=None, min_samples_leaf=1,
+                                                 random_state=0, n_jobs=1).fit(X, y)
+    floresta = helper_module.FlorestaPlana.de_floresta(modelo)
+    X_teste = np.vstack([_dados_floresta(n_saidas, semente=1)[0], X[:20]])
+
+    por_arvore = floresta.prever_por_arvore(X_teste)
+    esperado_por_arvore = np.stack([estimador.predict(X_teste) for estimador in modelo.estimators_])
+    assert por_arvore.shape == (len(modelo.estimators_), len(X_teste), n_saidas)
+    np.testing.assert_allclose(por_arvore, esperado_por_arvore.reshape(por_arvore.shape), rtol=1e-12, atol=1e-12)
+
+    previsto = floresta.predict(X_teste)
+    assert previsto.shape == modelo.predict(X_teste).shape
+    np.testing.assert_allclose(previsto, modelo.predict(X_teste), rtol=1e-10, atol=1e-10)
+
+    # Uma linha só (1-D), como nos buffers da previsão recursiva
+    np.testing.assert_allclose(floresta.predict(X_teste[0]), modelo.predict(X_teste[:1]), rtol=1e-10, atol=1e-10)
+    with pytest.raises(ValueError):
+        floresta.predict(X_teste[:, :-1])
+
+
+def _serie_intermitente():
+    # Três consumos em 120 dias, só um deles na janela dos resíduos: quase todas as somas
+    # sorteadas para o horizonte são zero
+    valores = np.zeros(120)
+    valores[[5, 20, 70]] = [4, 2, 3]
+    return valores
+
+
+@pytest.mark.parametrize('dias_para_prever', [1, 3, 7])
+@pytest.mark.parametrize('previsao_total', [0.17, 1.71, 5.0])
+def test_intervalo_taxa_contem_a_previsao_na_demanda_intermitente(previsao_total, dias_para_prever):
+    campos = helper_module.intervalo_taxa(_serie_intermitente(), previsao_total, dias_para_prever)
+    assert campos['previsao_p10'] <= campos['previsao_p50'] <= campos['previsao_p90']
+    assert campos['previsao_p10'] <= round(previsao_total, 2) <= campos['previsao_p90']
+    assert campos['previsao_p90'] > campos['previsao_p10'] # A faixa não degenera num ponto
+
+
+def test_previsao_da_camada_rapida_fica_dentro_da_faixa():
+    valores = _serie_intermitente()
+    dias = 19000 + np.flatnonzero(valores)
+    resultado = helper_module.obter_previsao_arrays(dias, valores[valores > 0], dias_para_prever=7)
+    assert resultado['metodo'] in [nome for nome, _ in helper_module.METODOS_CAMADA_RAPIDA.values()]
+    assert resultado['previsao_p10'] <= resultado['previsao'] <= resultado['previsao_p90']
+
+
+@pytest.mark.parametrize('horizonte', [1, 7])
+def test_janela_semanal_agrega_so_o_alvo(horizonte):
+    valores = np.random.default_rng(5).poisson(4, size=600).astype(float)
+    matriz, _ = helper_module.criar_features_temporais_np(valores, helper_module.numero_dia('2022-03-01'))
+    X = matriz[:, 1:]
+    y = matriz[:, 0] if horizonte == 1 else np.column_stack([matriz[:, 0]] * horizonte)
+
+    X_janela, y_janela, pesos, detalhes = helper_module.aplicar_janela_treino(X, y, 'semanal')
+
+    antigas = len(X) - helper_module.CORTE_SEMANAL_TREINO
+    semanas = detalhes['semanas_agregadas']
+    assert semanas == -(-antigas // 7) and len(X_janela) == semanas + helper_module.CORTE_SEMANAL_TREINO
+    np.testing.assert_array_equal(X_janela[semanas:], X[antigas:])
+    for semana in range(semanas):
+        linhas = slice(7 * semana, min(7 * semana + 7, antigas))
+        # As features são uma linha real da semana (calendário inteiro, como na previsão)
+        assert any(np.array_equal(X_janela[semana], linha) for linha in X[linhas])
+        np.testing.assert_allclose(y_janela[semana], y[linhas].mean(axis=0), rtol=1e-6)
+        assert pesos[semana] == len(X[linhas])
+    assert set(X_janela[:semanas, 0]) == set(range(7)) # Os dias da semana se alternam
+
+
+def _previsao_recursiva_pandas(modelo, df_com_features, dias_para_prever, lag_max=7, janela_movel=7):
+    """Previsão iterativa original: recalcula as features sobre todo o histórico a cada dia."""
+    colunas = df_com_features.columns.drop('quantidade')
+    historico = df_com_features.copy()
+    previsoes = []
+    for _ in range(dias_para_prever):
+        proxima_data = historico.index.max() + pd.Timedelta(days=1)
+        temporario = historico[['quantidade']].copy()
+        temporario.loc[proxima_data] = 0
+        features = helper_module.criar_features_temporais(temporario, lag_max=lag_max, janela_movel=janela_movel)
+        linha = features[colunas].tail(1)
+        previsao_dia = max(0, round(modelo.predict(linha.to_numpy())[0], 4))
+        previsoes.append(previsao_dia)
+        novo = linha.copy()
+        novo['quantidade'] = previsao_dia
+        historico = pd.concat([historico, novo[historico.columns]])
+    return previsoes
+
+
+def _historico_diario(semente=11, n=240):
+    rng = np.random.default_rng(semente)
+    dias = np.arange(n)
+    return np.round(rng.poisson(6 + 3 * np.sin(2 * np.pi * dias / 7)) + dias / 60).astype(float)
+
+
+def test_buffer_recursivo_igual_a_recursao_pandas():
+    valores = _historico_diario()
+    dia_inicial = helper_module.numero_dia('2023-11-20') # O horizonte atravessa a virada do ano
+    df_com_features = _features_pandas(valores, dia_inicial, 7, 7)
+    modelo = helper_module.criar_regressor('random_forest').set_params(n_jobs=1)
+    modelo.fit(df_com_features.drop(columns='quantidade').to_numpy(), df_com_features['quantidade'].to_numpy())
+    esperado = _previsao_recursiva_pandas(modelo, df_com_features, 45)
+
+    ultimo_dia = dia_inicial + len(valores) - 1
+    for previsor in (modelo, helper_module.FlorestaPlana.de_floresta(modelo)):
+        buffer = helper_module.BufferFeaturesRecursivas(valores, lag_max=7, janela_movel=7)
+        assert buffer.prever(previsor, ultimo_dia, 45) == esperado
+
+
+def test_previsao_recursiva_igual_a_original():
+    valores = _historico_diario()
+    dia_inicial = helper_module.numero_dia('2023-11-20')
+    df_com_features = _features_pandas(valores, dia_inicial, 7, 7)
+    modelo = helper_module.RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=1, max_depth=10, min_samples_split=5)
+    modelo.fit(df_com_features.drop(columns='quantidade').to_numpy(), df_com_features['quantidade'].to_numpy())
+    esperado = round(sum(_previsao_recursiva_pandas(modelo, df_com_features, 7)), 2)
+
+    dias = dia_inicial + np.flatnonzero(valores)
+    resultado = helper_module.obter_previsao_arrays(dias, valores[valores > 0], dias_para_prever=7, n_jobs=1, estrategia='recursiva',
+                                                    camada_rapida=False, janela_treino='completa')
+    assert resultado['metodo'] in ('RandomForestRegressor', 'FlorestaPlana')
+    assert resultado['previsao'] == esperado
+
+
+def _ses_recursiva(valores, alfa):
+    nivel = valores[0]
+    for y in valores[1:]:
+        nivel = alfa * y + (1 - alfa) * nivel
+    return nivel
+
+
+def test_estado_incremental_igual_a_ses_sobre_o_historico():
+    rng = np.random.default_rng(23)
+    dia_inicial = helper_module.numero_dia('2024-02-20')
+    # Consumos em ordem: vários no mesmo dia, dias seguidos e intervalos sem consumo
+    dias = dia_inicial + np.sort(np.concatenate([[0], rng.integers(0, 200, size=300), [200, 200, 260]]))
+    quantidades = rng.integers(1, 5, size=len(dias)).astype(float)
+
+    estado = helper_module.estado_incremental_de_valores([quantidades[0]], dias[0])
+    for numero, (dia, quantidade) in enumerate(zip(dias[1:], quantidades[1:]), start=1):
+        estado = helper_module.atualizar_estado_incremental(estado, dia, quantidade)
+        if numero % 50 and numero != len(dias) - 1:
+            continue
+        # A cada 50 consumos (e no último): o estado equivale à SES sobre a série diária até aqui
+        valores = np.zeros(dia - dia_inicial + 1)
+        np.add.at(valores, dias[:numero + 1] - dia_inicial, quantidades[:numero + 1])
+        nivel, momento1, momento2 = helper_module._fechar_estado(estado, helper_module.ALFA_SES, helper_module.ALFA_MOMENTOS_INCREMENTAL)
+        assert nivel == pytest.approx(_ses_recursiva(valores, helper_module.ALFA_SES), rel=1e-9)
+        assert nivel == pytest.approx(helper_module.taxa_ses(valores), rel=1e-9)
+        assert momento1 == pytest.approx(_ses_recursiva(valores, helper_module.ALFA_MOMENTOS_INCREMENTAL), rel=1e-9)
+        assert momento2 == pytest.approx(_ses_recursiva(valores ** 2, helper_module.ALFA_MOMENTOS_INCREMENTAL), rel=1e-9)
+        reconstruido = helper_module.estado_incremental_de_valores(valores, dia_inicial)
+        assert reconstruido['dia_corrente'] == estado['dia_corrente'] and reconstruido['acumulado'] == estado['acumulado']
+        assert reconstruido['nivel'] == pytest.approx(estado['nivel'], rel=1e-9)
+
+    previsao = helper_module.prever_estado_incremental(estado, 7)
+    assert previsao['previsao'] == round(max(0.0, helper_module.taxa_ses(valores)) * 7, 2)
+    # Consumo com data anterior ao dia corrente: o estado precisa ser remontado
+    assert helper_module.atualizar_estado_incremental(estado, dias[-1] - 1, 1.0) is None
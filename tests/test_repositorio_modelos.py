@@ -0,0 +1,42 @@
+import json
+import os
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+
+import helper_module
+
+
+def _repositorio_com_modelos_de_outras_bibliotecas(diretorio, itens):
+    repositorio = helper_module.RepositorioModelos(str(diretorio))
+    os.makedirs(repositorio.diretorio)
+    for item_id in itens:
+        with open(repositorio._arquivo(item_id), 'w') as f:
+            f.write('modelo antigo')
+    with open(repositorio._caminho_manifesto, 'w', encoding='utf-8') as f:
+        json.dump({'formato': helper_module.VERSAO_FORMATO_MODELOS, 'bibliotecas': {'sklearn': '0.0'},
+                   'modelos': {str(item_id): {'chave': ['antiga'], 'versao_historico': 'v'} for item_id in itens}}, f)
+    return repositorio
+
+
+def test_modelos_de_outras_bibliotecas_sao_descartados_sob_a_trava(tmp_path, monkeypatch):
+    repositorio = _repositorio_com_modelos_de_outras_bibliotecas(tmp_path, [1, 2, 3])
+    travas = []
+    remover = repositorio._remover_arquivo
+    monkeypatch.setattr(repositorio, '_remover_arquivo',
+                        lambda item_id: (travas.append(repositorio._com_trava_arquivo), remover(item_id)))
+
+    assert repositorio.carregar(1, ['antiga']) is None
+    assert travas == [True, True, True]
+    assert repositorio.descartados == 3
+    assert not any(nome.startswith('item_') for nome in os.listdir(repositorio.diretorio))
+    with open(repositorio._caminho_manifesto, encoding='utf-8') as f:
+        manifesto = json.load(f)
+    assert manifesto['modelos'] == {} and manifesto['bibliotecas'] == helper_module._versoes_bibliotecas()
+
+    # Outro processo (outra instância) encontra o manifesto já regravado e não descarta nada
+    modelo = LinearRegression().fit(np.zeros((2, 1)), np.zeros(2))
+    repositorio.salvar(4, ['nova'], modelo, 'v')
+    outro = helper_module.RepositorioModelos(str(tmp_path))
+    assert outro.carregar(4, ['nova']) is not None
+    assert outro.descartados == 0